@@ -1,10 +1,36 @@
 import json
+import os
 
 import requests
 from flask import Flask, abort, jsonify, request
+from redis import Redis
+
+from movies_api.cache import ResponseCache
 
 app = Flask("movies_service")
 
+MOVIES_INDEX = "movies"
+# кеш ответов: число записей в памяти процесса и время их жизни в секундах
+CACHE_SIZE = int(os.environ.get("api_cache_size", 1000))
+CACHE_TTL = float(os.environ.get("api_cache_ttl", 60))
+# хост Redis: общий кеш процессов и сброс записей по айди, которые публикует
+# etl процесс (es_publish_indexed=true); без него записи живут до CACHE_TTL
+CACHE_REDIS_HOST = os.environ.get("api_cache_redis_host", "")
+CACHE_CHANNEL = "es_indexed"
+
+cache = ResponseCache(
+    MOVIES_INDEX,
+    CACHE_SIZE,
+    CACHE_TTL,
+    Redis(host=CACHE_REDIS_HOST) if CACHE_REDIS_HOST else None,
+)
+if cache.redis is not None:
+    cache.subscribe(CACHE_CHANNEL)
+
+
+def cached_response(body: bytes):
+    return app.response_class(body, mimetype="application/json")
+
 
 @app.route("/api/movies/<movie_id>", methods=["GET"])
 def movie_details(movie_id: str) -> str:
@@ -12,7 +38,12 @@ def movie_details(movie_id: str) -> str:
     :param movie_id: идентификатор фильма.
     :return: данные из ES о фильме.
     """
-    url = f"http://127.0.0.1:9200/movies/_doc/{movie_id}"
+    key = f"movie:{movie_id}"
+    body = cache.get(key)
+    if body is not None:
+        return cached_response(body)
+    generation = cache.generation
+    url = f"http://127.0.0.1:9200/{MOVIES_INDEX}/_doc/{movie_id}"
     response = requests.get(url)
     json_data = json.loads(response.text).get("_source")
     if json_data is not None:
@@ -33,7 +64,9 @@ def movie_details(movie_id: str) -> str:
             genre=json_data.get("genre"),
             director=json_data.get("director"),
         )
-        return jsonify(data)
+        response = jsonify(data)
+        cache.set(key, response.get_data(), generation)
+        return response
     else:
         abort(response.status_code)
 
@@ -45,7 +78,8 @@ def movies_list() -> str:
     """
     try:
         args = request.args
-        search: str = args.get("search", "")
+        # лишние пробелы не меняют результат поиска и не должны менять ключ кеша
+        search: str = " ".join(args.get("search", "").split())
         limit: int = int(args.get("limit", 50))
         page: int = int(args.get("page", 1))
         sort: str = args.get("sort", "id")
@@ -60,7 +94,12 @@ def movies_list() -> str:
     except Exception:
         return abort(422)
 
-    url = "http://127.0.0.1:9200/movies/_search"
+    key = "list:" + json.dumps([search, limit, page, sort, sort_order])
+    body = cache.get(key)
+    if body is not None:
+        return cached_response(body)
+    generation = cache.generation
+    url = f"http://127.0.0.1:9200/{MOVIES_INDEX}/_search"
     from_value = page * limit - limit
 
     if search:
@@ -105,7 +144,9 @@ def movies_list() -> str:
                     imdb_rating=source_data["imdb_rating"],
                 )
             )
-        return jsonify(data)
+        response = jsonify(data)
+        cache.set(key, response.get_data(), generation)
+        return response
     else:
         abort(response.status_code)
 
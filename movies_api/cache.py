@@ -0,0 +1,164 @@
+import json
+import logging
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Iterable, Optional, Tuple
+
+from redis import Redis, RedisError
+
+_logger = logging.getLogger(__name__)
+
+# пауза перед повторной подпиской после потери соединения с Redis, секунды
+RESUBSCRIBE_DELAY = 5
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        LRU-кеш в памяти процесса: не больше maxsize записей,
+        каждая живет не дольше ttl секунд.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < monotonic():
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        with self.lock:
+            self.data[key] = (monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, keys: Iterable[str]) -> None:
+        with self.lock:
+            for key in keys:
+                self.data.pop(key, None)
+
+    def clear(self, prefix: str = "") -> None:
+        """Удаление всех записей, ключ которых начинается с prefix."""
+        with self.lock:
+            for key in [key for key in self.data if key.startswith(prefix)]:
+                del self.data[key]
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        index_name: str,
+        maxsize: int,
+        ttl: float,
+        redis: Optional[Redis] = None,
+        prefix: str = "movies_api:",
+    ):
+        """
+        Кеш ответов API по документам индекса index_name: в памяти процесса
+        и, если задан redis, в общем для всех процессов Redis с тем же ttl.
+        Ключи: movie:<айди> - документ, list:<параметры> - список или поиск.
+        Записи сбрасываются по сообщениям etl процесса (см. subscribe):
+        изменение документа удаляет его запись и все списки, так как
+        измененный документ может войти в любую выдачу.
+        """
+        self.index_name = index_name
+        self.local = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.redis = redis
+        self.prefix = prefix
+        # номер сброса: ответ, прочитанный из ES до сброса, в кеш не попадает
+        self.generation = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self.local.get(key)
+        if value is not None or self.redis is None:
+            return value
+        try:
+            value = self.redis.get(self.prefix + key)
+        except RedisError:
+            _logger.exception("Failed to read %s from Redis", key)
+            return None
+        if value is not None:
+            self.local.set(key, value)
+        return value
+
+    def set(self, key: str, value: bytes, generation: int) -> None:
+        """
+        Сохранение ответа, прочитанного из ES при номере сброса generation.
+        Если с тех пор кеш сбрасывался, ответ мог устареть и не сохраняется.
+        """
+        if generation != self.generation:
+            return
+        self.local.set(key, value)
+        if self.redis is None:
+            return
+        try:
+            self.redis.set(self.prefix + key, value, ex=max(int(self.ttl), 1))
+        except RedisError:
+            _logger.exception("Failed to write %s to Redis", key)
+
+    def invalidate(self, ids: Optional[Iterable[str]] = None) -> None:
+        """Сброс документов с айди из ids и всех списков, ids=None - всего кеша."""
+        self.generation += 1
+        if ids is None:
+            self.local.clear()
+            keys = None
+        else:
+            keys = [f"movie:{movie_id}" for movie_id in ids]
+            self.local.delete(keys)
+            self.local.clear("list:")
+        if self.redis is None:
+            return
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            if keys:
+                pipeline.delete(*(self.prefix + key for key in keys))
+            pattern = self.prefix + ("*" if keys is None else "list:*")
+            for key in self.redis.scan_iter(match=pattern, count=1000):
+                pipeline.delete(key)
+            pipeline.execute()
+        except RedisError:
+            _logger.exception("Failed to invalidate cache in Redis")
+
+    def subscribe(self, channel: str) -> Thread:
+        """
+        Фоновый поток, сбрасывающий кеш по сообщениям etl процесса в канале
+        channel: {"index": алиас, "ids": айди документов или null - весь индекс}.
+        После потери соединения кеш сбрасывается целиком, так как сообщения
+        за это время могли быть пропущены.
+        """
+        thread = Thread(target=self._listen, args=(channel,), daemon=True)
+        thread.start()
+        return thread
+
+    def _listen(self, channel: str) -> None:
+        resubscribed = False
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(channel)
+                if resubscribed:
+                    self.invalidate()
+                for message in pubsub.listen():
+                    try:
+                        data = json.loads(message["data"])
+                    except ValueError:
+                        _logger.error("Malformed message in %s", channel)
+                        continue
+                    if data.get("index") == self.index_name:
+                        self.invalidate(data.get("ids"))
+            except RedisError:
+                _logger.exception("Lost subscription to %s", channel)
+                sleep(RESUBSCRIBE_DELAY)
+            resubscribed = True
@@ -0,0 +1,101 @@
+"""Синтетический каталог фильмов для бенчмарков в форматах строк PostgresLoader."""
+
+import random
+import uuid
+from datetime import datetime
+from typing import List
+
+ROLES = ("actor", "writer", "director")
+
+
+class Catalogue:
+    def __init__(
+        self,
+        movies: int,
+        persons: int,
+        genres: int,
+        cast_mean: float,
+        max_cast: int,
+        seed: int = 0,
+    ):
+        """
+        Случайный каталог: размер состава фильма распределен экспоненциально
+        со средним cast_mean и ограничен max_cast, жанров у фильма от 1 до 4.
+        """
+        rnd = random.Random(seed)
+        self.now = datetime.now()
+        self.person_ids = [new_id(rnd) for _ in range(persons)]
+        self.genre_ids = [new_id(rnd) for _ in range(genres)]
+        self.movies = []
+        for _ in range(movies):
+            cast_size = 1 + int(rnd.expovariate(1 / max(cast_mean - 1, 1e-9)))
+            cast = rnd.sample(self.person_ids, min(cast_size, max_cast, persons))
+            self.movies.append(
+                {
+                    "id": new_id(rnd),
+                    "cast": [(person_id, rnd.choice(ROLES)) for person_id in cast],
+                    "genres": rnd.sample(
+                        self.genre_ids, rnd.randint(1, min(4, genres))
+                    ),
+                }
+            )
+
+    def movie_row(self, movie: dict) -> dict:
+        """Поля самого фильма, общие для обоих форматов строк."""
+        return {
+            "m_id": movie["id"],
+            "title": f"Movie {movie['id'][:8]}",
+            "description": "Synthetic movie",
+            "rating": 7.5,
+            "type": "movie",
+            "created": self.now,
+            "modified": self.now,
+            "auth_required": False,
+        }
+
+    def join_rows(self) -> List[dict]:
+        """Строки MOVIES_QUERY: фильм × персоны × жанры."""
+        rows = []
+        for movie in self.movies:
+            movie_row = self.movie_row(movie)
+            for person_id, role in movie["cast"]:
+                for genre_id in movie["genres"]:
+                    rows.append(
+                        dict(
+                            movie_row,
+                            role=role,
+                            p_id=person_id,
+                            p_name=f"Person {person_id[:8]}",
+                            g_id=genre_id,
+                            g_name=f"Genre {genre_id[:8]}",
+                        )
+                    )
+        return rows
+
+    def aggregated_rows(self) -> List[dict]:
+        """Строки AGGREGATED_MOVIES_QUERY: одна строка на фильм с json-массивами."""
+        return [
+            dict(
+                self.movie_row(movie),
+                persons=[
+                    {
+                        "id": person_id,
+                        "name": f"Person {person_id[:8]}",
+                        "role": role,
+                    }
+                    for person_id, role in movie["cast"]
+                ],
+                genres=[
+                    {
+                        "id": genre_id,
+                        "name": f"Genre {genre_id[:8]}",
+                    }
+                    for genre_id in movie["genres"]
+                ],
+            )
+            for movie in self.movies
+        ]
+
+
+def new_id(rnd: random.Random) -> str:
+    return str(uuid.UUID(int=rnd.getrandbits(128)))
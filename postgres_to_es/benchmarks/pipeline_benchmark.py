@@ -0,0 +1,214 @@
+"""
+Бенчмарк этапов etl процесса на синтетическом каталоге без Postgres и ES:
+выгрузка PostgresLoader из фейкового курсора, трансформация ETL,
+сериализация bulk-запроса ESLoader и отправка в HTTP-заглушку _bulk в том же процессе.
+
+Запуск из корня репозитория:
+    python -m postgres_to_es.benchmarks.pipeline_benchmark --movies 10000
+"""
+
+import argparse
+import json
+import os
+import resource
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Tuple
+
+# Бенчмарк не ходит в БД, но settings требует параметры подключения.
+for _name in ("db_host", "db_port", "db_name", "db_user", "db_password", "db_scheme"):
+    os.environ.setdefault(_name, "")
+
+from postgres_to_es.benchmarks.catalogue import Catalogue  # noqa: E402
+from postgres_to_es.src.es_loader import ESLoader  # noqa: E402
+from postgres_to_es.src.etl import ETL, coroutine  # noqa: E402
+from postgres_to_es.src.postgres_loader import PostgresLoader  # noqa: E402
+
+
+class FakeCursor:
+    """Курсор, который на любой запрос отдает заранее подготовленные строки."""
+
+    def __init__(self, rows: List[dict]):
+        self.rows = rows
+        self.itersize = 2000
+
+    def execute(self, query: str, params: tuple = ()) -> None:
+        pass
+
+    def fetchall(self) -> List[dict]:
+        return list(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+class FakeConnection:
+    """Соединение, все курсоры которого отдают одни и те же строки."""
+
+    def __init__(self, rows: List[dict]):
+        self.rows = rows
+
+    def cursor(self, name: str = None, cursor_factory=None) -> FakeCursor:
+        return FakeCursor(self.rows)
+
+
+class NoStorage:
+    """Хранилище без состояния: ETL читает его только при создании."""
+
+    def retrieve_state(self) -> dict:
+        return {}
+
+    def save_state(self, state: dict) -> None:
+        pass
+
+
+class BulkStub(BaseHTTPRequestHandler):
+    """Заглушка _bulk: принимает тело целиком и отвечает успехом без разбора."""
+
+    protocol_version = "HTTP/1.1"
+    received_bytes = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.lock:
+            BulkStub.received_bytes += len(body)
+        response = json.dumps({"errors": False, "items": []}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+def start_bulk_stub() -> str:
+    """Запускает заглушку _bulk в фоновом потоке, возвращает ее адрес."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BulkStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+@coroutine
+def collect(documents: List[dict]):
+    """Приемник документов фильмов из трансформера."""
+    while True:
+        movies = yield
+        documents.extend(movies)
+
+
+def extract(rows: List[dict], aggregated: bool) -> Callable[[], Tuple[int, int, int]]:
+    """Порции фильмов из фейкового серверного курсора."""
+
+    def run() -> Tuple[int, int, int]:
+        connection = FakeConnection(rows)
+        loader = PostgresLoader(connection, streaming=True, aggregated=aggregated)
+        return sum(len(chunk) for chunk in loader.iter_movies()), 0, 0
+
+    return run
+
+
+def transform(
+    rows: List[dict], aggregated: bool, documents: List[dict]
+) -> Callable[[], Tuple[int, int, int]]:
+    """
+    Трансформация строк в документы фильмов порциями, как их режет iter_movies:
+    все строки одного фильма попадают в одну порцию. Порции готовятся до замера.
+    """
+    chunks = list(
+        PostgresLoader(
+            FakeConnection(rows), streaming=True, aggregated=aggregated
+        ).iter_movies()
+    )
+
+    def run() -> Tuple[int, int, int]:
+        etl = ETL(
+            NoStorage(), PostgresLoader(FakeConnection([]), aggregated=aggregated), None
+        )
+        transformer = etl.get_transformer(collect(documents))
+        for chunk in chunks:
+            transformer.send(chunk)
+        transformer.send(None)
+        return len(rows), len(documents), 0
+
+    return run
+
+
+def serialize(documents: List[dict]) -> Callable[[], Tuple[int, int, int]]:
+    """Сборка тел bulk-запросов без отправки."""
+
+    def run() -> Tuple[int, int, int]:
+        loader = ESLoader()
+        size = 0
+        for batch in loader._iter_bulk_batches(
+            loader._get_es_bulk_query(documents, "movies")
+        ):
+            size += len(b"".join(batch))
+        return 0, len(documents), size
+
+    return run
+
+
+def bulk(
+    documents: List[dict], url: str, max_in_flight: int
+) -> Callable[[], Tuple[int, int, int]]:
+    """Отправка документов в заглушку _bulk."""
+
+    def run() -> Tuple[int, int, int]:
+        BulkStub.received_bytes = 0
+        loader = ESLoader(url=url, max_in_flight=max_in_flight)
+        loader.load_to_es(documents, "movies")
+        loader.flush()
+        return 0, len(documents), BulkStub.received_bytes
+
+    return run
+
+
+def measure(name: str, stage: Callable[[], Tuple[int, int, int]]) -> None:
+    """Печатает время, скорость, размер результата и пиковый RSS этапа."""
+    started = time.perf_counter()
+    rows, docs, size = stage()
+    elapsed = time.perf_counter() - started
+    # ru_maxrss в Linux в килобайтах, это пик процесса к концу этапа
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"{name:<20} {elapsed:8.3f} s {rows / elapsed:12.0f} rows/s "
+        f"{docs / elapsed:10.0f} docs/s {size / 2 ** 20:9.1f} MiB "
+        f"{peak_rss:8.1f} MiB RSS"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--movies", type=int, default=10000)
+    parser.add_argument("--persons", type=int, default=2000)
+    parser.add_argument("--genres", type=int, default=30)
+    parser.add_argument("--cast-mean", type=float, default=15)
+    parser.add_argument("--max-cast", type=int, default=100)
+    parser.add_argument("--max-in-flight", type=int, default=1)
+    args = parser.parse_args()
+
+    catalogue = Catalogue(
+        args.movies, args.persons, args.genres, args.cast_mean, args.max_cast
+    )
+    join_rows = catalogue.join_rows()
+    aggregated_rows = catalogue.aggregated_rows()
+    print(f"{args.movies} movies, {len(join_rows)} join rows")
+
+    measure("extract join", extract(join_rows, False))
+    measure("extract aggregated", extract(aggregated_rows, True))
+    movies = []
+    measure("transform join", transform(join_rows, False, movies))
+    movies = []
+    measure("transform aggregated", transform(aggregated_rows, True, movies))
+    measure("serialize", serialize(movies))
+    measure("bulk", bulk(movies, start_bulk_stub(), args.max_in_flight))
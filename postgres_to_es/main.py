@@ -1,36 +1,94 @@
 import logging
+from multiprocessing import Process
+from typing import Optional, Set
 
 import psycopg2
+from prometheus_client import start_http_server
 
+from postgres_to_es.src.document_hashes import DocumentHashes
 from postgres_to_es.src.es_loader import ESLoader
 from postgres_to_es.src.etl import ETL
+from postgres_to_es.src.listener import PostgresListener
 from postgres_to_es.src.postgres_loader import PostgresLoader
 from postgres_to_es.src.settings import (
     BASE_REDIS_HOST,
-    DB_HOST,
-    DB_NAME,
-    DB_PASSWORD,
-    DB_PORT,
-    DB_SCHEME,
-    DB_USER,
+    ES_HASHES_PATH,
+    ES_PUBLISH_INDEXED,
+    ES_SKIP_UNCHANGED,
+    ETL_LISTEN,
+    ETL_METRICS_PORT,
+    ETL_PARALLEL,
+    ETL_STORAGE,
+    ETL_STORAGE_PATH,
+    INDEX_NAMES,
+    POSTGRES_DSN,
+)
+from postgres_to_es.src.storage import (
+    BaseStorage,
+    Redis,
+    RedisStorage,
+    SQLiteStorage,
 )
-from postgres_to_es.src.storage import Redis, RedisStorage
 
 logging.basicConfig(level=logging.INFO)
 
-if __name__ == "__main__":
-    storage = RedisStorage(Redis(host=BASE_REDIS_HOST, decode_responses=True))
-    postgres_loader = PostgresLoader(
-        psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            options=f"-c search_path={DB_SCHEME}",
-        )
+
+def get_storage() -> BaseStorage:
+    """Хранилище чекпоинтов, выбранное параметром etl_storage (redis, sqlite)."""
+    if ETL_STORAGE == "sqlite":
+        return SQLiteStorage(ETL_STORAGE_PATH)
+    return RedisStorage(Redis(host=BASE_REDIS_HOST, decode_responses=True))
+
+
+def run_pipeline(indexes: Optional[Set[str]] = None, metrics_port: int = 0) -> None:
+    """
+    Запуск etl процесса, пишущего документы индексов indexes (по умолчанию всех),
+    со своими соединениями с Postgres, ES и хранилищем чекпоинтов.
+    metrics_port: порт метрик Prometheus, 0 - метрики не публикуются.
+    """
+    if metrics_port:
+        start_http_server(metrics_port)
+    storage = get_storage()
+    postgres_loader = PostgresLoader(psycopg2.connect(**POSTGRES_DSN))
+    hashes = DocumentHashes(ES_HASHES_PATH) if ES_SKIP_UNCHANGED else None
+    publisher = Redis(host=BASE_REDIS_HOST) if ES_PUBLISH_INDEXED else None
+    es_loader = ESLoader(hashes=hashes, publisher=publisher)
+    listener = PostgresListener() if ETL_LISTEN else None
+    # журналы читают все процессы etl: один или по процессу на индекс
+    journal_consumers = (
+        [ETL.get_checkpoint_prefix({index}) for index in INDEX_NAMES]
+        if ETL_PARALLEL
+        else [ETL.get_checkpoint_prefix(set(INDEX_NAMES))]
+    )
+    etl = ETL(
+        storage,
+        postgres_loader,
+        es_loader,
+        listener=listener,
+        indexes=indexes,
+        journal_consumers=journal_consumers,
     )
-    es_loader = ESLoader()
-    etl = ETL(storage, postgres_loader, es_loader)
-    logging.info("ETL PROCESS STARTED")
     etl.start_etl_pipeline()
+
+
+if __name__ == "__main__":
+    logging.info("ETL PROCESS STARTED")
+    if not ETL_PARALLEL:
+        run_pipeline(metrics_port=ETL_METRICS_PORT)
+    else:
+        # каждый индекс пишет свой процесс, чтобы пересборка одного индекса
+        # не задерживала остальные и трансформация шла на нескольких ядрах.
+        # Один документ пишет только один процесс, поэтому записи документа
+        # не обгоняют друг друга. Метрики процесса - на etl_metrics_port + номер
+        processes = [
+            Process(
+                target=run_pipeline,
+                args=({index}, ETL_METRICS_PORT and ETL_METRICS_PORT + number),
+                name=f"etl_{INDEX_NAMES[index]}",
+            )
+            for number, index in enumerate(INDEX_NAMES)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
@@ -0,0 +1,44 @@
+import argparse
+import logging
+
+import psycopg2
+from elasticsearch import Elasticsearch
+from redis import Redis
+
+from postgres_to_es.src.es_loader import ESLoader
+from postgres_to_es.src.postgres_loader import PostgresLoader
+from postgres_to_es.src.reindex import Reindexer
+from postgres_to_es.src.settings import (
+    BASE_ES_URL,
+    BASE_REDIS_HOST,
+    ES_PUBLISH_INDEXED,
+    POSTGRES_DSN,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Полная переиндексация фильмов, жанров и персон с переключением алиасов."
+    )
+    parser.add_argument(
+        "--delete-old",
+        action="store_true",
+        help="удалить предыдущие версии индексов после переключения алиасов",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="число процессов загрузки, таблицы делятся между ними по диапазонам uuid",
+    )
+    args = parser.parse_args()
+
+    reindexer = Reindexer(
+        Elasticsearch(hosts=BASE_ES_URL),
+        PostgresLoader(psycopg2.connect(**POSTGRES_DSN), streaming=True),
+        ESLoader(publisher=Redis(host=BASE_REDIS_HOST) if ES_PUBLISH_INDEXED else None),
+    )
+    logging.info("REINDEX STARTED")
+    reindexer.run(delete_old=args.delete_old, workers=args.workers)
+    logging.info("REINDEX FINISHED")
@@ -0,0 +1,62 @@
+import sqlite3
+from hashlib import blake2b
+from typing import Dict, Iterable, List, Tuple
+
+# размер хеша документа: 8 байт хватает, чтобы случайное совпадение
+# у измененного документа было практически невозможно
+DIGEST_SIZE = 8
+# ограничение числа параметров одного запроса SQLite
+QUERY_CHUNK_SIZE = 500
+
+
+def document_digest(body: bytes) -> bytes:
+    """Хеш сериализованного документа."""
+    return blake2b(body, digest_size=DIGEST_SIZE).digest()
+
+
+class DocumentHashes:
+    def __init__(self, path: str):
+        """
+        Хеши документов, уже загруженных в ES, в локальном файле SQLite (WAL).
+        Ключ - индекс (алиас) и айди документа, значение - DIGEST_SIZE байт.
+        """
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL;")
+        self.connection.execute("PRAGMA synchronous=NORMAL;")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS document_hashes "
+            "(index_name TEXT, id TEXT, digest BLOB NOT NULL, "
+            "PRIMARY KEY (index_name, id)) WITHOUT ROWID;"
+        )
+
+    def get_many(self, index_name: str, ids: List[str]) -> Dict[str, bytes]:
+        """Сохраненные хеши документов индекса с айди из ids."""
+        digests = {}
+        for start in range(0, len(ids), QUERY_CHUNK_SIZE):
+            chunk = ids[start : start + QUERY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            digests.update(
+                self.connection.execute(
+                    "SELECT id, digest FROM document_hashes "
+                    f"WHERE index_name = ? AND id IN ({placeholders});",
+                    [index_name, *chunk],
+                )
+            )
+        return digests
+
+    def save_many(self, records: Iterable[Tuple[str, str, bytes]]) -> None:
+        """Сохранение хешей (индекс, айди, хеш) одной транзакцией."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO document_hashes (index_name, id, digest) VALUES (?, ?, ?) "
+                "ON CONFLICT (index_name, id) DO UPDATE SET digest = excluded.digest;",
+                records,
+            )
+
+    def delete_many(self, index_name: str, ids: Iterable[str]) -> None:
+        """Удаление хешей документов, удаленных из ES или отклоненных им."""
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM document_hashes WHERE index_name = ? AND id = ?;",
+                [(index_name, document_id) for document_id in ids],
+            )
@@ -1,57 +1,416 @@
+import gzip
 import json
 import logging
-from typing import List
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from time import sleep
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from urllib.parse import urljoin
 
+import backoff
 import requests
+from redis import Redis, RedisError
+from requests.adapters import HTTPAdapter
 
-from postgres_to_es.src.settings import BASE_ES_URL, DEFAULT_MOVIE_INDEX_NAME
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from postgres_to_es.src.document_hashes import DocumentHashes, document_digest
+from postgres_to_es.src.metrics import (
+    BULK_BYTES,
+    BULK_ITEM_FAILURES,
+    BULK_REQUESTS,
+    DOCUMENTS_SKIPPED,
+    STAGE_LATENCY,
+)
+from postgres_to_es.src.settings import (
+    BASE_ES_URL,
+    DEFAULT_MOVIE_INDEX_NAME,
+    ES_BULK_MAX_BYTES,
+    ES_BULK_MAX_DOCS,
+    ES_DEAD_LETTER_PATH,
+    ES_GZIP,
+    ES_GZIP_LEVEL,
+    ES_INDEXED_CHANNEL,
+    ES_MAX_IN_FLIGHT,
+    ES_MAX_RETRIES,
+    ES_POOL_SIZE,
+    ES_RETRY_DELAY,
+    ES_RETRY_MAX_DELAY,
+)
 
 _logger = logging.getLogger(__name__)
 
+# статусы, при которых запрос или документ стоит отправить повторно
+RETRYABLE_STATUSES = {429, 502, 503, 504}
+
+
+def dumps(value) -> bytes:
+    """JSON в байтах UTF-8: orjson, если установлен, иначе стандартный json."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class ESBulkError(Exception):
+    """Документы не удалось загрузить в ES после всех повторов."""
+
 
 class ESLoader:
-    def __init__(self, url: str = BASE_ES_URL):
+    def __init__(
+        self,
+        url: str = BASE_ES_URL,
+        use_gzip: bool = ES_GZIP,
+        pool_size: int = ES_POOL_SIZE,
+        max_bytes: int = ES_BULK_MAX_BYTES,
+        max_docs: int = ES_BULK_MAX_DOCS,
+        max_in_flight: int = ES_MAX_IN_FLIGHT,
+        max_retries: int = ES_MAX_RETRIES,
+        retry_delay: float = ES_RETRY_DELAY,
+        dead_letter_path: str = ES_DEAD_LETTER_PATH,
+        hashes: Optional[DocumentHashes] = None,
+        publisher: Optional[Redis] = None,
+        channel: str = ES_INDEXED_CHANNEL,
+    ):
+        """
+        url: адрес Elasticsearch.
+        use_gzip: сжимать тело bulk-запроса (Content-Encoding: gzip).
+        pool_size: размер пула keep-alive соединений сессии.
+        max_bytes, max_docs: ограничения размера одного bulk-запроса.
+        max_in_flight: число одновременно выполняемых bulk-запросов.
+        max_retries, retry_delay: повторы документов, отклоненных перегруженным
+        кластером, и начальная задержка между ними в секундах.
+        dead_letter_path: файл для документов с неисправимыми ошибками.
+        hashes: хеши загруженных документов; если заданы, документы, не изменившиеся
+        с прошлой загрузки, не отправляются. Без них (например, при переиндексации)
+        отправляются все документы.
+        publisher, channel: Redis, в канал channel которого после подтверждения
+        загрузки в flush() публикуются айди измененных и удаленных документов,
+        чтобы movies_api сбросил их в своем кеше.
+        """
         self.url = url
+        self.use_gzip = use_gzip
+        self.max_bytes = max_bytes
+        self.max_docs = max_docs
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.dead_letter_path = dead_letter_path
+        self.dead_letter_lock = Lock()
+        self.hashes = hashes
+        # хеши отправленных документов, сохраняются после подтверждения в flush()
+        self.pending_hashes: List[Tuple[str, str, bytes]] = []
+        self.publisher = publisher
+        self.channel = channel
+        # айди отправленных документов по индексам, публикуются в flush()
+        self.pending_ids: Dict[str, List[str]] = defaultdict(list)
+        # (индекс, айди) документов, записанных в dead letter файл
+        self.rejected: List[Tuple[str, str]] = []
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_in_flight, thread_name_prefix="es_bulk"
+        )
+        self.in_flight = BoundedSemaphore(max_in_flight)
+        self.pending: List[Future] = []
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(pool_size, max_in_flight)
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     @staticmethod
-    def _get_es_bulk_query(rows: List[dict], index_name: str) -> List[str]:
+    def _get_action_template(action: str, index_name: str) -> Tuple[bytes, bytes]:
+        """
+        Заранее закодированные начало и конец строки действия для индекса,
+        между ними подставляется айди документа.
+        """
+        prefix = f'{{"{action}":{{"_index":'.encode() + dumps(index_name)
+        return prefix + b',"_id":', b"}}\n"
+
+    @classmethod
+    def _get_es_bulk_query(
+        cls, rows: Iterable[dict], index_name: str
+    ) -> Iterator[bytes]:
         """
         Подготавливает bulk-запрос в Elasticsearch.
+        Отдает по одному элементу запроса (строка действия и строка документа)
+        в байтах на каждую запись, не собирая весь запрос в памяти.
         """
-        prepared_query = []
-        for row in rows:
-            prepared_query.extend(
-                [
-                    json.dumps({"index": {"_index": index_name, "_id": row["uuid"]}}),
-                    json.dumps(row),
-                ]
-            )
-        return prepared_query
+        return cls._get_es_index_query(
+            ((row["uuid"], dumps(row)) for row in rows), index_name
+        )
+
+    @classmethod
+    def _get_es_index_query(
+        cls, documents: Iterable[Tuple[str, bytes]], index_name: str
+    ) -> Iterator[bytes]:
+        """Элементы bulk-запроса из уже сериализованных документов (айди, тело)."""
+        prefix, suffix = cls._get_action_template("index", index_name)
+        for document_id, body in documents:
+            yield b"".join((prefix, dumps(document_id), suffix, body, b"\n"))
+
+    @classmethod
+    def _get_es_delete_query(
+        cls, ids: Iterable[str], index_name: str
+    ) -> Iterator[bytes]:
+        """Элементы bulk-запроса на удаление документов: только строка действия."""
+        prefix, suffix = cls._get_action_template("delete", index_name)
+        for document_id in ids:
+            yield prefix + dumps(document_id) + suffix
+
+    def _iter_bulk_batches(self, entries: Iterable[bytes]) -> Iterator[List[bytes]]:
+        """
+        Разбивает элементы bulk-запроса на пачки, не изменяя исходные записи.
+        Пачка закрывается, когда следующий элемент превысит max_bytes
+        или в ней уже max_docs элементов.
+        """
+        batch = []
+        batch_bytes = 0
+        for item in entries:
+            if batch and (
+                batch_bytes + len(item) > self.max_bytes or len(batch) >= self.max_docs
+            ):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(item)
+            batch_bytes += len(item)
+        if batch:
+            yield batch
+
+    @backoff.on_exception(
+        backoff.expo, requests.exceptions.ConnectionError, max_tries=ES_MAX_RETRIES
+    )
+    def _post_bulk(self, body: bytes) -> requests.Response:
+        """Отправка тела bulk-запроса через общую сессию, при необходимости сжатого."""
+        headers = {"Content-Type": "application/x-ndjson"}
+        if self.use_gzip:
+            body = gzip.compress(body, compresslevel=ES_GZIP_LEVEL)
+            headers["Content-Encoding"] = "gzip"
+        return self.session.post(urljoin(self.url, "_bulk"), data=body, headers=headers)
+
+    def _load_batch(self, batch: List[bytes]) -> None:
+        """
+        Отправка одной пачки в ES и разбор ответа по каждому документу.
+        Документы, отклоненные из-за перегрузки кластера, отправляются повторно
+        с экспоненциальной задержкой, остальные ошибки пишутся в dead letter файл.
+        Если после max_retries попыток остались отклоненные документы,
+        выбрасывается ESBulkError.
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                delay = min(self.retry_delay * 2 ** (attempt - 1), ES_RETRY_MAX_DELAY)
+                _logger.warning(
+                    "Retrying %s rejected documents in %s s", len(batch), delay
+                )
+                sleep(delay)
+            _logger.info("Loading %s documents to ES", len(batch))
+            body = b"".join(batch)
+            BULK_REQUESTS.inc()
+            BULK_BYTES.inc(len(body))
+            with STAGE_LATENCY.labels("bulk").time():
+                response = self._post_bulk(body)
+            if response.status_code in RETRYABLE_STATUSES:
+                continue
+            response.raise_for_status()
+
+            json_response = json.loads(response.content.decode())
+            if not json_response.get("errors"):
+                return
+            rejected = []
+            for entry, item in zip(batch, json_response.get("items", [])):
+                # ключ элемента ответа совпадает с типом действия: index, delete...
+                result = next(iter(item.values()))
+                if not result.get("error"):
+                    continue
+                if self._is_retryable(result):
+                    BULK_ITEM_FAILURES.labels("retryable").inc()
+                    rejected.append(entry)
+                else:
+                    BULK_ITEM_FAILURES.labels("dead_letter").inc()
+                    self._dead_letter(entry, result)
+            if not rejected:
+                return
+            batch = rejected
+        raise ESBulkError(
+            f"{len(batch)} documents were rejected after {self.max_retries} retries"
+        )
+
+    @staticmethod
+    def _is_retryable(result: dict) -> bool:
+        """Ошибка документа временная: кластер перегружен или недоступен."""
+        error = result.get("error") or {}
+        return (
+            result.get("status") in RETRYABLE_STATUSES
+            or error.get("type") == "es_rejected_execution_exception"
+        )
+
+    def _dead_letter(self, entry: bytes, result: dict) -> None:
+        """Сохраняет документ с неисправимой ошибкой в dead letter файл (NDJSON)."""
+        _logger.error(result["error"])
+        # у действия delete нет строки документа
+        action, _, source = entry.rstrip(b"\n").partition(b"\n")
+        record = {
+            "status": result.get("status"),
+            "error": result["error"],
+            "action": json.loads(action),
+            "source": json.loads(source) if source else None,
+        }
+        meta = next(iter(record["action"].values()))
+        with self.dead_letter_lock, open(self.dead_letter_path, "a") as file:
+            file.write(json.dumps(record) + "\n")
+            self.rejected.append((meta["_index"], meta["_id"]))
 
     def load_to_es(
         self, records: List[dict], index_name: str = DEFAULT_MOVIE_INDEX_NAME
     ):
         """
-        Отправка запроса в ES и разбор ошибок сохранения данных
-        """
-        if records:
-            start_number = 0
-            end_number = 100
-            while len(records) > 0:
-                records_to_load = records[start_number:end_number]
-                prepared_query = self._get_es_bulk_query(records_to_load, index_name)
-                del records[start_number:end_number]
-                str_query = "\n".join(prepared_query) + "\n"
-                _logger.info("Loading data to ES")
-                response = requests.post(
-                    urljoin(self.url, "_bulk"),
-                    data=str_query,
-                    headers={"Content-Type": "application/x-ndjson"},
-                )
+        Отправка записей в ES пачками через пул потоков.
+        Одновременно выполняется не больше max_in_flight bulk-запросов: если все
+        слоты заняты, вызов ждет освобождения слота и тем самым притормаживает
+        выгрузку из Postgres. Дождаться отправленных пачек можно через flush().
+        """
+        if self.hashes is None:
+            if self.publisher is not None:
+                self.pending_ids[index_name].extend(row["uuid"] for row in records)
+            self._submit(self._get_es_bulk_query(records, index_name))
+            return
+        documents = self._skip_unchanged(records, index_name)
+        if self.publisher is not None:
+            self.pending_ids[index_name].extend(uuid for uuid, _ in documents)
+        self._submit(self._get_es_index_query(documents, index_name))
+
+    def _skip_unchanged(
+        self, records: List[dict], index_name: str
+    ) -> List[Tuple[str, bytes]]:
+        """
+        Сериализует записи и оставляет только документы, хеш которых отличается
+        от сохраненного. Хеши оставленных документов ждут подтверждения ES.
+        """
+        documents = [(row["uuid"], dumps(row)) for row in records]
+        stored = self.hashes.get_many(index_name, [uuid for uuid, _ in documents])
+        changed = []
+        for document_id, body in documents:
+            digest = document_digest(body)
+            if stored.get(document_id) == digest:
+                continue
+            changed.append((document_id, body))
+            self.pending_hashes.append((index_name, document_id, digest))
+        DOCUMENTS_SKIPPED.labels(index_name).inc(len(documents) - len(changed))
+        return changed
+
+    def delete_from_es(
+        self, ids: Iterable[str], index_name: str = DEFAULT_MOVIE_INDEX_NAME
+    ) -> None:
+        """
+        Удаление документов из ES действиями delete в тех же bulk-пачках,
+        с теми же повторами и ограничением числа запросов, что и у load_to_es.
+        Удаление отсутствующего документа (404) ошибкой не считается.
+        """
+        ids = list(ids)
+        self.forget(ids, index_name)
+        self._submit(self._get_es_delete_query(ids, index_name))
+
+    def forget(self, ids: List[str], index_name: str) -> None:
+        """
+        Удаляет сохраненные хеши документов, измененных в ES в обход load_to_es,
+        чтобы следующая полная пересборка их не пропустила, и ставит их айди
+        в очередь публикации.
+        """
+        if self.hashes is not None:
+            self.hashes.delete_many(index_name, ids)
+        if self.publisher is not None:
+            self.pending_ids[index_name].extend(ids)
+
+    @property
+    def tracks_documents(self) -> bool:
+        """Нужны ли айди документов, измененных в обход load_to_es (forget)."""
+        return self.hashes is not None or self.publisher is not None
 
-                json_response = json.loads(response.content.decode())
-                for item in json_response.get("items", []):
-                    error_message = item["index"].get("error")
-                    if error_message:
-                        _logger.error(error_message)
+    def publish(self, index_name: str, ids: Optional[List[str]] = None) -> None:
+        """
+        Публикация айди измененных документов индекса в канал publisher,
+        ids=None - изменился весь индекс (например, после переключения алиаса).
+        Ошибка Redis не останавливает etl процесс: кеш устареет не дольше,
+        чем на время жизни записей.
+        """
+        if self.publisher is None:
+            return
+        try:
+            self.publisher.publish(
+                self.channel, dumps({"index": index_name, "ids": ids})
+            )
+        except RedisError:
+            _logger.exception("Failed to publish indexed documents of %s", index_name)
+
+    @backoff.on_exception(
+        backoff.expo, requests.exceptions.ConnectionError, max_tries=ES_MAX_RETRIES
+    )
+    def refresh(self, index_names: List[str]) -> None:
+        """Refresh индексов: подтвержденные изменения становятся видны поиску."""
+        response = self.session.post(
+            urljoin(self.url, f"{','.join(index_names)}/_refresh")
+        )
+        response.raise_for_status()
+
+    @backoff.on_exception(
+        backoff.expo, requests.exceptions.ConnectionError, max_tries=ES_MAX_RETRIES
+    )
+    def update_by_query(self, index_name: str, query: dict, script: dict) -> dict:
+        """
+        Частичное обновление документов, найденных query, скриптом script
+        (_update_by_query). Поиск идет по последнему refresh индекса, поэтому
+        перед вызовом индекс нужно обновить (refresh). Документы, измененные
+        после поиска, пропускаются (conflicts=proceed) и попадают в version_conflicts:
+        их новая версия могла быть собрана из старых данных, вызывающий должен
+        пересобрать такие документы.
+        :return: ответ ES: updated, noops, version_conflicts...
+        """
+        response = self.session.post(
+            urljoin(self.url, f"{index_name}/_update_by_query"),
+            params={"conflicts": "proceed"},
+            data=dumps({"query": query, "script": script}),
+            headers={"Content-Type": "application/json"},
+        )
+        response.raise_for_status()
+        result = json.loads(response.content.decode())
+        if result.get("failures"):
+            raise ESBulkError(f"Update by query failed: {result['failures'][:3]}")
+        return result
+
+    def _submit(self, entries: Iterable[bytes]) -> None:
+        """Отправка элементов bulk-запроса пачками через пул потоков."""
+        for batch in self._iter_bulk_batches(entries):
+            self.in_flight.acquire()
+            future = self.executor.submit(self._load_batch, batch)
+            future.add_done_callback(lambda _: self.in_flight.release())
+            self.pending.append(future)
+
+    def flush(self) -> None:
+        """
+        Ожидание всех отправленных пачек.
+        Пробрасывает ошибку первой неудачной пачки, чтобы чекпоинт не сдвинулся.
+        После подтверждения всех пачек сохраняет хеши отправленных документов,
+        кроме записанных в dead letter файл, и публикует айди документов.
+        Перед публикацией индексы с изменениями обновляются (refresh): иначе
+        movies_api после сброса кеша прочитал бы из поиска прежние данные
+        и закешировал их снова.
+        """
+        pending, self.pending = self.pending, []
+        hashes, self.pending_hashes = self.pending_hashes, []
+        published, self.pending_ids = self.pending_ids, defaultdict(list)
+        for future in pending:
+            future.result()
+        with self.dead_letter_lock:
+            rejected, self.rejected = set(self.rejected), []
+        if hashes:
+            self.hashes.save_many(
+                record for record in hashes if record[:2] not in rejected
+            )
+        published = {index_name: ids for index_name, ids in published.items() if ids}
+        if published:
+            self.refresh(list(published))
+        for index_name, ids in published.items():
+            self.publish(index_name, ids)
@@ -1,12 +1,30 @@
 import logging
+from datetime import datetime, timezone
 from functools import wraps
-from time import sleep
-from typing import Coroutine, Dict, List, Optional
+from random import random
+from time import monotonic, perf_counter, sleep
+from typing import Coroutine, Dict, List, Optional, Sequence, Set, Tuple, Type
 
 import backoff
-from pydantic import BaseModel
-
-from postgres_to_es.src.settings import DEFAULT_DATE, DEFAULT_SLEEP_TIME
+from pydantic import BaseModel, ValidationError
+
+from postgres_to_es.src.metrics import (
+    CHECKPOINT_LAG,
+    DOCUMENTS_TRANSFORMED,
+    STAGE_LATENCY,
+)
+from postgres_to_es.src.settings import (
+    DEFAULT_DATE,
+    DEFAULT_ID,
+    DEFAULT_SLEEP_TIME,
+    DEFAULT_TXID,
+    ETL_JOURNAL_TABLES,
+    ETL_LISTEN_TIMEOUT,
+    ETL_PAGE_SIZE,
+    ETL_PARTIAL_UPDATES,
+    ETL_VALIDATION_RATE,
+    INDEX_NAMES,
+)
 
 _logger = logging.getLogger(__name__)
 
@@ -21,205 +39,646 @@ def coroutine(func):
     return inner
 
 
+# вложенные поля документа фильма с персонами и жанрами: (поля, поле имени)
+NESTED_NAME_FIELDS: Dict[str, Tuple[Tuple[str, ...], str]] = {
+    "person": (("actors", "writers", "directors"), "full_name"),
+    "genre": (("genres",), "name"),
+}
+# обновляет имена во вложенных полях, документ без изменений не перезаписывается
+UPDATE_NAMES_SCRIPT = """
+boolean changed = false;
+for (field in params.fields) {
+    def items = ctx._source[field];
+    if (items == null) { continue; }
+    for (item in items) {
+        def name = params.names[item.uuid];
+        if (name != null && item[params.name_field] != name) {
+            item[params.name_field] = name;
+            changed = true;
+        }
+    }
+}
+if (!changed) { ctx.op = 'noop'; }
+"""
+
+
+def format_date(value: datetime) -> str:
+    """Дата в ISO 8601: isoformat заметно быстрее strftime с форматом."""
+    return value.isoformat(timespec="microseconds")
+
+
 class ETL:
-    def __init__(self, storage, db_loader, es_loader):
+    def __init__(
+        self,
+        storage,
+        db_loader,
+        es_loader,
+        validation_rate: float = ETL_VALIDATION_RATE,
+        listener=None,
+        partial_updates: bool = ETL_PARTIAL_UPDATES,
+        indexes: Optional[Set[str]] = None,
+        journal_consumers: Sequence[str] = (),
+    ):
+        """
+        partial_updates: изменения персон и жанров обновляют в документах фильмов
+        только имена (_update_by_query) вместо полной пересборки связанных фильмов.
+        indexes: направления (ключи INDEX_NAMES), документы которых пишет процесс,
+        по умолчанию все. Каждый индекс должен писать только один процесс:
+        тогда документ перезаписывается в том же порядке, в каком читался из
+        Postgres, и устаревшая копия или удаленный документ не попадут в ES
+        последними. Чекпоинты процесса с частью индексов хранятся отдельно.
+        journal_consumers: префиксы чекпоинтов (get_checkpoint_prefix) всех
+        процессов, читающих журналы ETL_JOURNAL_TABLES. Если заданы, записи
+        журналов, обработанные всеми процессами, удаляются (purge_journal).
+        Без них журналы не чистятся, например при догрузке после переиндексации,
+        чекпоинты которой не сохраняются.
+        """
         self.storage = storage
         self.state = storage.retrieve_state()
         self.db_loader = db_loader
         self.es_loader = es_loader
-        self.current_table = ""
+        self.validation_rate = validation_rate
+        self.listener = listener
+        self.partial_updates = partial_updates
+        self.indexes = set(INDEX_NAMES) if indexes is None else set(indexes)
+        self.checkpoint_prefix = self.get_checkpoint_prefix(self.indexes)
+        self.journal_consumers = journal_consumers
+
+    @staticmethod
+    def get_checkpoint_prefix(indexes: Set[str]) -> str:
+        """Префикс чекпоинтов процесса, пишущего документы индексов indexes."""
+        if set(indexes) == set(INDEX_NAMES):
+            return ""
+        return ",".join(sorted(indexes)) + ":"
 
     @backoff.on_exception(backoff.expo, Exception)
-    def start_etl_pipeline(self) -> None:
+    def start_etl_pipeline(self, tables: Optional[Set[str]] = None) -> None:
+        """
+        Загрузка фильмов, жанров и персон из постгреса в ES.
+        tables: обрабатываемые направления, по умолчанию все.
+        Без listener раз в sleep_time секунд запускает etl процесс с нуля.
+        С listener проход запускается по уведомлению из Postgres только для
+        измененных таблиц, а полный проход - если уведомлений не было ETL_LISTEN_TIMEOUT
+        секунд или соединение слушателя было потеряно.
+        """
+        producers = self.build_producers()
+        tables = set(producers) if tables is None else tables & set(producers)
+        changed = tables
+        while True:
+            self.run_cycle(producers, changed)
+            changed = self.wait_for_changes(tables)
+
+    def wait_for_changes(self, tables: Set[str]) -> Set[str]:
         """
-        Последовательная загрузка фильмов, жанров и персон из постгреса в ES.
-        Раз в sleep_time секунд запускает etl процесс с нуля.
+        Ожидание следующего прохода, возвращает таблицы из tables для обработки.
+        Уведомления по другим таблицам пропускаются, не сдвигая таймаут.
         """
-        loader = self.loader()
-        transformer = self.transform_movie_data(loader)
-        movie_merger = self.db_loader.load_movie_data(transformer)
-        movie_producer = self.get_ids_for_update(movie_merger)
-        genre_producer = self.get_ids_for_update(
-            self.db_loader.get_movie_ids(movie_merger, "movie_genre_rel", "genre_id")
+        if self.listener is None:
+            sleep(DEFAULT_SLEEP_TIME)
+            return tables
+        deadline = monotonic() + ETL_LISTEN_TIMEOUT
+        while True:
+            changed = self.listener.wait(max(deadline - monotonic(), 0))
+            if not changed:
+                return tables
+            if changed & tables:
+                return changed & tables
+
+    def build_producers(self) -> Dict[str, Coroutine]:
+        """
+        Цепочки корутин для таблиц, изменения которых затрагивают документы
+        индексов self.indexes.
+        """
+        movie_merger = self.db_loader.load_movie_data(
+            self.get_transformer(self.loader())
         )
-        person_producer = self.get_ids_for_update(
-            self.db_loader.get_movie_ids(movie_merger, "movie_person_rel", "person_id")
+        writes_movies = "movie" in self.indexes
+        producers = {}
+        if writes_movies:
+            producers["movie"] = self.get_ids_for_update(movie_merger)
+        for table_name, relation in (
+            ("genre", "movie_genre_rel"),
+            ("person", "movie_person_rel"),
+        ):
+            if writes_movies:
+                movies_target = (
+                    self.update_movie_names(movie_merger, table_name)
+                    if self.partial_updates
+                    else self.db_loader.get_movie_ids(
+                        movie_merger, relation, f"{table_name}_id"
+                    )
+                )
+            elif table_name in self.indexes:
+                movies_target = None
+            else:
+                continue
+            producers[table_name] = self.get_ids_for_update(
+                self.load_updated_documents(movies_target, table_name)
+            )
+        producers["relation_changes"] = self.get_ids_for_update(
+            self.load_relation_changes(movie_merger if writes_movies else None)
         )
+        producers["tombstones"] = self.get_ids_for_update(self.delete_documents())
+        return producers
 
-        while True:
+    def run_cycle(
+        self, producers: Dict[str, Coroutine], tables: Optional[Set[str]] = None
+    ) -> None:
+        """Один проход etl процесса по направлениям tables (по умолчанию по всем)."""
+        tables = set(producers) if tables is None else tables & set(producers)
+        if "movie" in tables:
             _logger.info("Movie loading started")
-            self.current_table = "movie"
-            movie_producer.send("movie")
+            producers["movie"].send("movie")
 
+        if "genre" in tables:
             _logger.info("Movies from updated genres are loading")
-            self.current_table = "genre"
-            genre_producer.send("genre")
+            producers["genre"].send("genre")
 
+        if "person" in tables:
             _logger.info("Movies from updated persons are loading")
-            self.current_table = "person"
-            person_producer.send("person")
+            producers["person"].send("person")
+
+        if "relation_changes" in tables:
+            _logger.info("Documents from updated relations are loading")
+            producers["relation_changes"].send("relation_changes")
+
+        # удаления последними, чтобы пересборка связанных документов их не вернула;
+        # в etl_parallel это верно, так как индекс пишет только один процесс
+        if "tombstones" in tables:
+            _logger.info("Deleted documents are removing")
+            producers["tombstones"].send("tombstones")
+
+    def get_transformer(self, target: Coroutine) -> Coroutine:
+        """Трансформер, подходящий под формат строк db_loader."""
+        if self.db_loader.aggregated:
+            return self.transform_aggregated_movie_data(target)
+        return self.transform_movie_data(target)
+
+    def load_all(
+        self,
+        index_names: Dict[str, str],
+        id_range: Optional[Tuple[str, Optional[str]]] = None,
+    ) -> None:
+        """
+        Полная выгрузка фильмов, жанров и персон в индексы index_names.
+        id_range: ограничивает выгрузку полуинтервалом айди каждой таблицы.
+        Фильмы собираются обычным трансформером, а жанры и персоны - отдельными
+        запросами, чтобы film_ids каждого документа были полными.
+        """
+        transformer = self.get_transformer(self.loader(index_names))
+        for chunk in self.db_loader.iter_movies(id_range=id_range):
+            transformer.send(chunk)
+        transformer.send(None)
+
+        self.load_genres(index_names["genre"], id_range=id_range)
+        self.load_persons(index_names["person"], id_range=id_range)
+        self.es_loader.flush()
+
+    def load_genres(
+        self,
+        index_name: str,
+        ids: Optional[Sequence[str]] = None,
+        id_range: Optional[Tuple[str, Optional[str]]] = None,
+    ) -> None:
+        """Выгрузка жанров с полными film_ids в индекс index_name."""
+        for chunk in self.db_loader.iter_genres(ids=ids, id_range=id_range):
+            started = perf_counter()
+            genres = [self.genre_document(row) for row in chunk]
+            self.validate_sample(Genre, genres)
+            self.observe_transform("genre", genres, started)
+            self.es_loader.load_to_es(genres, index_name)
+
+    def load_persons(
+        self,
+        index_name: str,
+        ids: Optional[Sequence[str]] = None,
+        id_range: Optional[Tuple[str, Optional[str]]] = None,
+    ) -> None:
+        """Выгрузка персон с полными film_ids и ролями в индекс index_name."""
+        for chunk in self.db_loader.iter_persons(ids=ids, id_range=id_range):
+            started = perf_counter()
+            persons = [self.person_document(row) for row in chunk]
+            self.validate_sample(Person, persons)
+            self.observe_transform("person", persons, started)
+            self.es_loader.load_to_es(persons, index_name)
 
-            sleep(DEFAULT_SLEEP_TIME)
+    @backoff.on_exception(backoff.expo, Exception)
+    @coroutine
+    def load_updated_documents(
+        self, target: Optional[Coroutine], table_name: str
+    ) -> Coroutine:
+        """
+        Пересборка документов жанров или персон (table_name), айди которых
+        приходит в ids, с полными film_ids, если процесс пишет их индекс.
+        Айди передаются дальше в target (если задан) для обновления связанных фильмов.
+        """
+        load_documents = {"genre": self.load_genres, "person": self.load_persons}
+        while True:
+            ids: tuple = (yield)
+            last_checkpoint: str = (yield)
+            if ids and table_name in self.indexes:
+                load_documents[table_name](INDEX_NAMES[table_name], ids=ids)
+            if target is not None:
+                target.send(ids)
+                target.send(last_checkpoint)
+
+    @backoff.on_exception(backoff.expo, Exception)
+    @coroutine
+    def update_movie_names(self, target: Coroutine, table_name: str) -> Coroutine:
+        """
+        Частичное обновление фильмов при изменении персон или жанров (table_name),
+        айди которых приходит в ids. Из персоны и жанра в документ фильма попадает
+        только имя, поэтому достаточно обновить его во вложенных полях.
+        Изменения состава фильма приходят через content.relation_changes
+        и пересобирают фильмы целиком (load_relation_changes).
+        Перед обновлением индекс фильмов обновляется (refresh), чтобы поиск нашел
+        только что загруженные фильмы. Если фильм изменился между поиском и
+        обновлением (version_conflicts), его версия могла быть собрана со старым
+        именем, поэтому связанные фильмы пересобираются целиком через target.
+        """
+        fields, name_field = NESTED_NAME_FIELDS[table_name]
+        relation = {"person": "movie_person_rel", "genre": "movie_genre_rel"}
+        movie_index = INDEX_NAMES["movie"]
+        while True:
+            ids: tuple = (yield)
+            last_checkpoint: str = (yield)
+            if not ids:
+                continue
+            names = self.db_loader.get_names(table_name, ids)
+            query = {
+                "bool": {
+                    "should": [
+                        {
+                            "nested": {
+                                "path": field,
+                                "query": {"terms": {f"{field}.uuid": list(names)}},
+                            }
+                        }
+                        for field in fields
+                    ]
+                }
+            }
+            script = {
+                "source": UPDATE_NAMES_SCRIPT,
+                "lang": "painless",
+                "params": {
+                    "fields": fields,
+                    "name_field": name_field,
+                    "names": names,
+                },
+            }
+            self.es_loader.refresh([movie_index])
+            result = self.es_loader.update_by_query(movie_index, query, script)
+            _logger.info("Names updated in %s movies", result.get("updated", 0))
+            conflicts = result.get("version_conflicts", 0)
+            if conflicts:
+                _logger.warning(
+                    "%s version conflicts, rebuilding related movies", conflicts
+                )
+            if not conflicts and not self.es_loader.tracks_documents:
+                continue
+            for movie_ids in self.db_loader.iter_related_movie_ids(
+                relation[table_name], f"{table_name}_id", ids
+            ):
+                if conflicts:
+                    target.send(tuple(movie_ids))
+                    target.send(last_checkpoint)
+                else:
+                    self.es_loader.forget(movie_ids, movie_index)
+
+    @backoff.on_exception(backoff.expo, Exception)
+    @coroutine
+    def load_relation_changes(self, target: Optional[Coroutine]) -> Coroutine:
+        """
+        Обработка записей журнала content.relation_changes, айди которых приходит в ids.
+        Журнал заполняется триггерами movie_person_rel и movie_genre_rel, в том числе
+        при удалении связей. Затронутые фильмы отправляются в target,
+        а затронутые персоны и жанры пересобираются целиком, так как их film_ids
+        могли как пополниться, так и сократиться.
+        Пересобираются только документы индексов self.indexes, target - None,
+        если процесс не пишет фильмы.
+        """
+        while True:
+            ids: tuple = (yield)
+            last_checkpoint: str = (yield)
+            if not ids:
+                continue
+            movie_ids, person_ids, genre_ids = self.db_loader.get_relation_changes(ids)
+            if target is not None:
+                target.send(tuple(movie_ids))
+                target.send(last_checkpoint)
+            if person_ids and "person" in self.indexes:
+                self.load_persons(INDEX_NAMES["person"], ids=person_ids)
+            if genre_ids and "genre" in self.indexes:
+                self.load_genres(INDEX_NAMES["genre"], ids=genre_ids)
+
+    @backoff.on_exception(backoff.expo, Exception)
+    @coroutine
+    def delete_documents(self) -> Coroutine:
+        """
+        Удаление из ES документов по записям content.tombstones, айди которых
+        приходит в ids. Записи заполняются триггерами удаления фильмов, персон и жанров.
+        """
+        while True:
+            ids: tuple = (yield)
+            last_checkpoint: str = (yield)
+            if not ids:
+                continue
+            for table_name, document_ids in self.db_loader.get_tombstones(ids).items():
+                if table_name in self.indexes:
+                    self.es_loader.delete_from_es(document_ids, INDEX_NAMES[table_name])
 
     @backoff.on_exception(backoff.expo, Exception)
     @coroutine
     def get_ids_for_update(self, target: Coroutine) -> Coroutine:
         """
         Выгрузка айдишников из БД для выбранного направления (фильм, персона, жанр).
+        Таблица обходится постранично по ключу (modified, id), начиная с сохраненного
+        чекпоинта, пока не будут выгружены все изменения.
+        Журналы ETL_JOURNAL_TABLES обходятся по ключу (txid, id) и только до
+        границы фиксации: записи транзакций младше самой старой незавершенной
+        транзакции ждут следующего прохода. Так запись транзакции, начатой раньше,
+        а зафиксированной позже, не окажется позади чекпоинта.
         table_name: назывние таблицы
-        last_checkpoint: самый последний modified для выбранного направления.
-        storage_data: словарь данного направления из локального хранилища.
+        last_checkpoint: modified (txid для журналов) последней обработанной записи.
+        last_id: id последней обработанной записи с этим modified (txid).
+        Ключи чекпоинтов начинаются с checkpoint_prefix; если своего чекпоинта
+        еще нет, обход начинается с общего чекпоинта таблицы без префикса.
         :return: айдишники данного направления для обновления, last_checkpoint.
         """
 
         while True:
             table_name: str = (yield)
-            last_checkpoint = self.state.get(
-                f"{table_name}_last_modified", DEFAULT_DATE
-            )
-            query = """
+            journal = table_name in ETL_JOURNAL_TABLES
+            if journal:
+                position, default_position = "txid", DEFAULT_TXID
+                query = f"""
+                    SELECT id, modified, txid::text as txid
+                    FROM content.{table_name}
+                    WHERE (txid, id) > (%s::xid8, %s::uuid)
+                        AND txid < pg_snapshot_xmin(pg_current_snapshot())
+                    ORDER BY txid, id
+                    LIMIT %s;
+                """
+            else:
+                position, default_position = "modified", DEFAULT_DATE
+                query = f"""
                     SELECT id, modified
-                    FROM content.%s
-                    WHERE modified > '%s'
-                    ORDER BY modified
-                    LIMIT 100;
-                """ % (
-                table_name,
-                last_checkpoint,
-            )
-            self.db_loader.cr.execute(query)
-            object_ids = self.db_loader.cr.fetchall()
-            ids_for_update = []
-            for obj in object_ids:
-                object_id = obj.get("id")
-                modified = obj.get("modified").strftime("%Y-%m-%d %H:%M:%S.%f")
-                if last_checkpoint < modified:
-                    ids_for_update.append(object_id)
-                    self.state.update({f"{table_name}_last_modified": modified})
-            target.send(tuple(ids_for_update))
-            target.send(last_checkpoint)
-            self.storage.save_state(self.state)
+                    FROM content.{table_name}
+                    WHERE (modified, id) > (%s::timestamptz, %s::uuid)
+                    ORDER BY modified, id
+                    LIMIT %s;
+                """
+            position_key = f"{self.checkpoint_prefix}{table_name}_last_{position}"
+            id_key = f"{self.checkpoint_prefix}{table_name}_last_id"
+            processed = False
+            while True:
+                last_checkpoint = self.state.get(
+                    position_key,
+                    self.state.get(f"{table_name}_last_{position}", default_position),
+                )
+                last_id = self.state.get(
+                    id_key, self.state.get(f"{table_name}_last_id", DEFAULT_ID)
+                )
+                with STAGE_LATENCY.labels("postgres").time():
+                    self.db_loader.cr.execute(
+                        query, (last_checkpoint, last_id, ETL_PAGE_SIZE)
+                    )
+                    object_ids = self.db_loader.cr.fetchall()
+                if not object_ids:
+                    CHECKPOINT_LAG.labels(table_name).set(0)
+                    break
+                target.send(tuple(obj["id"] for obj in object_ids))
+                target.send(last_checkpoint)
+                # чекпоинт сдвигается только после того, как ES принял всю страницу
+                self.es_loader.flush()
+                last_object = object_ids[-1]
+                checkpoint = (
+                    last_object["txid"]
+                    if journal
+                    else format_date(last_object["modified"])
+                )
+                self.state.update({position_key: checkpoint, id_key: last_object["id"]})
+                self.storage.save_state(self.state)
+                processed = True
+                lag = datetime.now(timezone.utc) - last_object["modified"]
+                CHECKPOINT_LAG.labels(table_name).set(lag.total_seconds())
+                if len(object_ids) < ETL_PAGE_SIZE:
+                    break
+            # журнал чистит процесс, который последним дочитал новые записи
+            if processed and journal and self.journal_consumers:
+                self.purge_journal(table_name)
+
+    def purge_journal(self, table_name: str) -> None:
+        """
+        Удаление записей журнала table_name, которые уже обработали все процессы
+        journal_consumers. Чекпоинты другого режима etl_parallel не учитываются:
+        записи до чекпоинтов текущих процессов уже попали во все индексы, и
+        процесс прежнего режима после обратного переключения дочитает оставшиеся.
+        """
+        state = self.storage.retrieve_state()
+        key = f"{table_name}_last_txid"
+        checkpoints = [
+            state.get(prefix + key, state.get(key, DEFAULT_TXID))
+            for prefix in self.journal_consumers
+        ]
+        deleted = self.db_loader.purge_journal(table_name, checkpoints)
+        if deleted:
+            _logger.info("%s records purged from %s", deleted, table_name)
 
     @backoff.on_exception(backoff.expo, Exception)
     @coroutine
     def transform_movie_data(self, target: Coroutine) -> Coroutine:
-        """Трансформация данных выбранного направления (фильм, персона, жанр) в объект Movie."""
+        """
+        Трансформация строк фильмов в документы ES.
+        Строки приходят порциями, строки одного фильма всегда в одной порции.
+        Документы жанров и персон собираются отдельными запросами (load_genres,
+        load_persons), поэтому конец пачки (None) здесь ничего не отправляет.
+        """
         while True:
-            data: list = (yield)
+            data: Optional[list] = (yield)
+            if data is None:
+                continue
+            started = perf_counter()
             movies = {}
-            persons = {}
-            genres = {}
+            # уже добавленные в фильм пары (роль, айди персоны) и ("genre", айди жанра)
+            movie_seen = {}
             for line in data:
                 movie_id = line["m_id"]
-                movie_name = line["title"]
-                movie_data = dict(
-                    uuid=movie_id,
-                    title=movie_name,
-                    description=line["description"],
-                    imdb_rating=line["rating"],
-                    type=line["type"],
-                    auth_required=line["auth_required"],
-                    created_at=line["created"].strftime("%Y-%m-%d %H:%M:%S.%f"),
-                    updated_at=line["modified"].strftime("%Y-%m-%d %H:%M:%S.%f"),
-                )
                 movie = movies.get(movie_id)
                 if not movie:
-                    # создаем новый объект фильма
-                    movie = Movie(**movie_data)
-                person_id = line.get("p_id")
-                person_name = line.get("p_name")
-                person_data = [{"uuid": person_id, "full_name": person_name}]
+                    # создаем новый документ фильма
+                    movie = {
+                        "uuid": movie_id,
+                        "title": line["title"],
+                        "description": line["description"],
+                        "imdb_rating": line["rating"],
+                        "type": line["type"],
+                        "auth_required": line["auth_required"],
+                        "created_at": format_date(line["created"]),
+                        "updated_at": format_date(line["modified"]),
+                        "actors": [],
+                        "writers": [],
+                        "directors": [],
+                        "genres": [],
+                    }
+                    movies[movie_id] = movie
+                    movie_seen[movie_id] = set()
+                seen = movie_seen[movie_id]
+                person_data = {
+                    "uuid": line.get("p_id"),
+                    "full_name": line.get("p_name"),
+                }
                 person_role = line["role"]
 
                 if person_role == "director":
-                    self.set_person(movie.directors, person_data, person_id)
+                    self.set_person(movie["directors"], seen, person_data, person_role)
                 elif person_role == "actor":
-                    self.set_person(movie.actors, person_data, person_id)
+                    self.set_person(movie["actors"], seen, person_data, person_role)
                 elif person_role == "writer":
-                    self.set_person(movie.writers, person_data, person_id)
-
-                if self.current_table == "person":
-                    person = persons.get(person_id)
-                    if not person:
-                        person_created = line.get("p_created")
-                        person_modified = line.get("p_modified")
-                        person = Person(
-                            uuid=person_id,
-                            full_name=person_name,
-                            roles=[person_role],
-                            film_ids=[movie_id],
-                            created_at=person_created.strftime("%Y-%m-%d %H:%M:%S.%f"),
-                            updated_at=person_modified.strftime("%Y-%m-%d %H:%M:%S.%f"),
-                        )
-                        persons.update({person_id: person})
-                    else:
-                        person = persons[person_id]
-
-                        existing_roles = person.roles
-                        if person_role not in existing_roles:
-                            existing_roles.append(person_role)
-
-                        existing_movies = person.film_ids
-                        if movie_id not in existing_movies:
-                            existing_movies.append(movie_id)
+                    self.set_person(movie["writers"], seen, person_data, person_role)
 
                 genre_id = line.get("g_id")
-                genre_name = line.get("g_name")
-                if not any(genre_id == g.get("uuid") for g in movie.genres):
-                    movie.genres += [{"uuid": genre_id, "name": genre_name}]
-
-                if self.current_table == "genre":
-                    genre_description = line.get("g_description")
-                    genre_created = line.get("g_created")
-                    genre_modified = line.get("g_modified")
-                    genre = genres.get(genre_id)
-                    if not genre:
-                        # создаем новый объект жанра
-                        genre = Genre(
-                            uuid=genre_id,
-                            name=genre_name,
-                            description=genre_description,
-                            film_ids=[movie_id],
-                            created_at=genre_created.strftime("%Y-%m-%d %H:%M:%S.%f"),
-                            updated_at=genre_modified.strftime("%Y-%m-%d %H:%M:%S.%f"),
-                        )
-                        genres.update({genre_id: genre})
-                    else:
-                        existing_movies = genres[genre_id].film_ids
-                        if movie_id not in existing_movies:
-                            existing_movies.append(movie_id)
-
-                movies.update({movie_id: movie})
-            movies = [movie.dict(by_alias=True) for movie in movies.values()]
-            genres = [genre.dict(by_alias=True) for genre in genres.values()]
-            persons = [person.dict(by_alias=True) for person in persons.values()]
+                if genre_id and ("genre", genre_id) not in seen:
+                    seen.add(("genre", genre_id))
+                    movie["genres"].append(
+                        {"uuid": genre_id, "name": line.get("g_name")}
+                    )
+
+            movies = list(movies.values())
+            self.validate_sample(Movie, movies)
+            self.observe_transform("movie", movies, started)
             target.send(movies)
-            target.send(genres)
-            target.send(persons)
+
+    @backoff.on_exception(backoff.expo, Exception)
+    @coroutine
+    def transform_aggregated_movie_data(self, target: Coroutine) -> Coroutine:
+        """
+        Трансформация предагрегированных строк (одна строка на фильм) в документы ES.
+        Персоны и жанры фильма приходят готовыми json-массивами, поэтому
+        дедупликация строк не нужна.
+        """
+        while True:
+            data: Optional[list] = (yield)
+            if data is None:
+                continue
+            started = perf_counter()
+            movies = []
+            for line in data:
+                movie_persons = line["persons"]
+                movies.append(
+                    {
+                        "uuid": line["m_id"],
+                        "title": line["title"],
+                        "description": line["description"],
+                        "imdb_rating": line["rating"],
+                        "type": line["type"],
+                        "auth_required": line["auth_required"],
+                        "created_at": format_date(line["created"]),
+                        "updated_at": format_date(line["modified"]),
+                        "actors": self.get_role_persons(movie_persons, "actor"),
+                        "writers": self.get_role_persons(movie_persons, "writer"),
+                        "directors": self.get_role_persons(movie_persons, "director"),
+                        "genres": [
+                            {"uuid": g["id"], "name": g["name"]} for g in line["genres"]
+                        ],
+                    }
+                )
+            self.validate_sample(Movie, movies)
+            self.observe_transform("movie", movies, started)
+            target.send(movies)
+
+    @staticmethod
+    def get_role_persons(
+        movie_persons: List[Dict[str, str]], role: str
+    ) -> List[Dict[str, str]]:
+        """Персоны фильма с выбранной ролью в формате документа фильма."""
+        return [
+            {"uuid": p["id"], "full_name": p["name"]}
+            for p in movie_persons
+            if p["role"] == role
+        ]
+
+    @staticmethod
+    def observe_transform(entity: str, documents: List[dict], started: float) -> None:
+        """Метрики сборки порции документов, started - время начала сборки."""
+        STAGE_LATENCY.labels("transform").observe(perf_counter() - started)
+        DOCUMENTS_TRANSFORMED.labels(entity).inc(len(documents))
+
+    def validate_sample(self, model: Type[BaseModel], documents: List[dict]) -> None:
+        """
+        Выборочная проверка собранных документов схемой pydantic.
+        Документы собираются обычными словарями, а схема проверяет долю
+        validation_rate из них: 0 - проверка выключена, 1 - проверяются все.
+        """
+        if not self.validation_rate:
+            return
+        for document in documents:
+            if self.validation_rate < 1 and random() >= self.validation_rate:
+                continue
+            try:
+                model(**document)
+            except ValidationError as error:
+                _logger.error(
+                    "Invalid %s document %s: %s",
+                    model.__name__,
+                    document.get("uuid"),
+                    error,
+                )
 
     @staticmethod
     @backoff.on_exception(backoff.expo, Exception)
     def set_person(
-        person_list_ids: List[Dict[str, str]], person_data: list, person_id: str
+        person_list: List[Dict[str, str]],
+        seen: Set[Tuple[str, str]],
+        person_data: Dict[str, str],
+        person_role: str,
     ) -> None:
-        """Проверяет наличие персоны в объекте фильма."""
-        if not any(person_id == p.get("uuid") for p in person_list_ids):
-            person_list_ids += person_data
+        """
+        Добавляет персону в список фильма, если ее там еще нет.
+        seen: уже добавленные в фильм пары (роль, айди персоны).
+        """
+        key = (person_role, person_data["uuid"])
+        if key not in seen:
+            seen.add(key)
+            person_list.append(person_data)
+
+    @staticmethod
+    def genre_document(row: dict) -> dict:
+        """Документ жанра из строки PostgresLoader.iter_genres."""
+        return {
+            "uuid": row["id"],
+            "name": row["name"],
+            "description": row["description"],
+            "film_ids": row["film_ids"],
+            "created_at": format_date(row["created"]),
+            "updated_at": format_date(row["modified"]),
+        }
+
+    @staticmethod
+    def person_document(row: dict) -> dict:
+        """Документ персоны из строки PostgresLoader.iter_persons."""
+        return {
+            "uuid": row["id"],
+            "full_name": row["name"],
+            "film_ids": row["film_ids"],
+            "roles": row["roles"],
+            "created_at": format_date(row["created"]),
+            "updated_at": format_date(row["modified"]),
+        }
 
     @backoff.on_exception(backoff.expo, Exception)
     @coroutine
-    def loader(self) -> Coroutine:
+    def loader(self, index_names: Optional[Dict[str, str]] = None) -> Coroutine:
         """
-        Загрузка в ES. Возвращает 409, если документ с таким айди уже существует.
-        Принимает movie_data: Список словарей с фильмами, персонами и жанрами.
+        Загрузка документов фильмов в ES.
+        Принимает movie_data: список документов фильмов от трансформера.
+        index_names: индексы (или алиасы) направлений, по умолчанию INDEX_NAMES.
         """
+        index_names = index_names or INDEX_NAMES
         while True:
             movie_data: list = (yield)
-            genre_data: list = (yield)
-            person_data: list = (yield)
-            self.es_loader.load_to_es(movie_data, "movies")
-            self.es_loader.load_to_es(genre_data, "genres")
-            self.es_loader.load_to_es(person_data, "persons")
+            self.es_loader.load_to_es(movie_data, index_names["movie"])
 
 
 class Movie(BaseModel):
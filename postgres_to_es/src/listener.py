@@ -0,0 +1,50 @@
+import logging
+import select
+from typing import Optional, Set
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from postgres_to_es.src.settings import ETL_NOTIFY_CHANNEL, POSTGRES_DSN
+
+_logger = logging.getLogger(__name__)
+
+
+class PostgresListener:
+    def __init__(self, dsn: dict = POSTGRES_DSN, channel: str = ETL_NOTIFY_CHANNEL):
+        """
+        Подписка на уведомления об изменениях (LISTEN/NOTIFY).
+        Триггеры из schema_design/init.sql присылают в channel имя измененной таблицы.
+        Слушатель держит отдельное соединение в режиме autocommit.
+        """
+        self.dsn = dsn
+        self.channel = channel
+        self.connection = None
+
+    def connect(self) -> None:
+        """Открывает соединение и подписывается на канал."""
+        self.connection = psycopg2.connect(**self.dsn)
+        self.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel};")
+
+    def wait(self, timeout: float) -> Optional[Set[str]]:
+        """
+        Ждет уведомлений не дольше timeout секунд.
+        :return: таблицы, в которых были изменения; пустое множество по таймауту;
+        None, если соединение потеряно и изменения могли быть пропущены.
+        """
+        try:
+            if self.connection is None or self.connection.closed:
+                self.connect()
+                return None
+            if not self.connection.notifies:
+                select.select([self.connection], [], [], timeout)
+            self.connection.poll()
+        except psycopg2.Error as error:
+            _logger.error("Listener connection lost: %s", error)
+            self.connection = None
+            return None
+        tables = {notify.payload for notify in self.connection.notifies}
+        self.connection.notifies.clear()
+        return tables
@@ -0,0 +1,56 @@
+"""
+Метрики etl процесса в формате Prometheus.
+Сервер метрик запускается в main.py, если задан etl_metrics_port.
+"""
+
+from time import perf_counter
+from typing import Iterator, List
+
+from prometheus_client import Counter, Gauge, Histogram
+
+ROWS_EXTRACTED = Counter(
+    "etl_rows_extracted_total", "Строки, выгруженные из Postgres", ["entity"]
+)
+DOCUMENTS_TRANSFORMED = Counter(
+    "etl_documents_transformed_total", "Документы, собранные для ES", ["entity"]
+)
+DOCUMENTS_SKIPPED = Counter(
+    "etl_documents_skipped_total",
+    "Документы, не отправленные в ES, так как не изменились",
+    ["index"],
+)
+BULK_REQUESTS = Counter("etl_bulk_requests_total", "Bulk-запросы в ES")
+BULK_BYTES = Counter(
+    "etl_bulk_bytes_total", "Размер тел bulk-запросов до сжатия, байты"
+)
+BULK_ITEM_FAILURES = Counter(
+    "etl_bulk_item_failures_total",
+    "Элементы bulk-запросов с ошибкой: retryable - отправлены повторно, "
+    "dead_letter - записаны в dead letter файл",
+    ["reason"],
+)
+STAGE_LATENCY = Histogram(
+    "etl_stage_latency_seconds",
+    "Длительность этапов: postgres - запрос или порция курсора, "
+    "transform - сборка документов порции, bulk - один bulk-запрос",
+    ["stage"],
+)
+CHECKPOINT_LAG = Gauge(
+    "etl_checkpoint_lag_seconds",
+    "Отставание чекпоинта: now - modified последней обработанной записи, "
+    "0 - изменений не осталось",
+    ["table"],
+)
+
+
+def observe_chunks(entity: str, chunks: Iterator[List[dict]]) -> Iterator[List[dict]]:
+    """
+    Считает строки порций из Postgres и время получения каждой порции,
+    не включая время их обработки потребителем.
+    """
+    started = perf_counter()
+    for chunk in chunks:
+        STAGE_LATENCY.labels("postgres").observe(perf_counter() - started)
+        ROWS_EXTRACTED.labels(entity).inc(len(chunk))
+        yield chunk
+        started = perf_counter()
@@ -1,10 +1,125 @@
+import logging
 from datetime import datetime
 from functools import wraps
-from typing import Coroutine
+from typing import Coroutine, Dict, Iterator, List, Optional, Sequence, Tuple
 
 import backoff
+import psycopg2
 from psycopg2.extras import RealDictCursor
 
+from postgres_to_es.src.metrics import observe_chunks
+from postgres_to_es.src.settings import (
+    DEFAULT_ID,
+    ETL_PAGE_SIZE,
+    POSTGRES_AGGREGATED,
+    POSTGRES_ITERSIZE,
+    POSTGRES_STREAMING,
+)
+
+_logger = logging.getLogger(__name__)
+
+# Запросы документов отсортированы по айди, условие выборки подставляется в {condition}.
+# Вложенные персоны, жанры и film_ids тоже упорядочены, чтобы один и тот же документ
+# всегда сериализовался одинаково (см. ESLoader._skip_unchanged).
+MOVIES_QUERY = """
+    SELECT
+        m.id as m_id,
+        m.title,
+        m.description,
+        m.rating,
+        m.type,
+        m.created,
+        m.modified,
+        m.auth_required,
+        movie_person.role as role,
+        p.id as p_id,
+        p.name as p_name,
+        g.id as g_id,
+        g.name as g_name
+    FROM content.movie m
+    LEFT JOIN content.movie_person_rel movie_person ON movie_person.movie_id = m.id
+    LEFT JOIN content.person p ON p.id = movie_person.person_id
+    LEFT JOIN content.movie_genre_rel gm ON gm.movie_id = m.id
+    LEFT JOIN content.genre g ON g.id = gm.genre_id
+    WHERE {condition}
+    ORDER BY m.id, p.id, movie_person.role, g.id;
+"""
+
+AGGREGATED_MOVIES_QUERY = """
+    SELECT
+        m.id as m_id,
+        m.title,
+        m.description,
+        m.rating,
+        m.type,
+        m.created,
+        m.modified,
+        m.auth_required,
+        COALESCE(movie_person.persons, '[]') as persons,
+        COALESCE(movie_genre.genres, '[]') as genres
+    FROM content.movie m
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_object(
+            'id', p.id,
+            'name', p.name,
+            'role', pm.role
+        ) ORDER BY p.id, pm.role) as persons
+        FROM content.movie_person_rel pm
+        JOIN content.person p ON p.id = pm.person_id
+        WHERE pm.movie_id = m.id
+    ) movie_person ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_object(
+            'id', g.id,
+            'name', g.name
+        ) ORDER BY g.id) as genres
+        FROM content.movie_genre_rel gm
+        JOIN content.genre g ON g.id = gm.genre_id
+        WHERE gm.movie_id = m.id
+    ) movie_genre ON TRUE
+    WHERE {condition}
+    ORDER BY m.id;
+"""
+
+PERSONS_QUERY = """
+    SELECT
+        p.id,
+        p.name,
+        p.created,
+        p.modified,
+        COALESCE(
+            array_agg(DISTINCT pm.movie_id::text) FILTER (WHERE pm.movie_id IS NOT NULL),
+            ARRAY[]::text[]
+        ) as film_ids,
+        COALESCE(
+            array_agg(DISTINCT pm.role::text) FILTER (WHERE pm.role IS NOT NULL),
+            ARRAY[]::text[]
+        ) as roles
+    FROM content.person p
+    LEFT JOIN content.movie_person_rel pm ON pm.person_id = p.id
+    WHERE {condition}
+    GROUP BY p.id
+    ORDER BY p.id;
+"""
+
+GENRES_QUERY = """
+    SELECT
+        g.id,
+        g.name,
+        g.description,
+        g.created,
+        g.modified,
+        COALESCE(
+            array_agg(gm.movie_id::text ORDER BY gm.movie_id) FILTER (WHERE gm.movie_id IS NOT NULL),
+            ARRAY[]::text[]
+        ) as film_ids
+    FROM content.genre g
+    LEFT JOIN content.movie_genre_rel gm ON gm.genre_id = g.id
+    WHERE {condition}
+    GROUP BY g.id
+    ORDER BY g.id;
+"""
+
 
 def coroutine(func):
     @wraps(func)
@@ -18,77 +133,239 @@ def coroutine(func):
 
 class PostgresLoader:
     @backoff.on_exception(backoff.expo, Exception)
-    def __init__(self, connection):
+    def __init__(
+        self,
+        connection,
+        streaming: bool = POSTGRES_STREAMING,
+        itersize: int = POSTGRES_ITERSIZE,
+        aggregated: bool = POSTGRES_AGGREGATED,
+        page_size: int = ETL_PAGE_SIZE,
+    ):
         """
         1) Инициализация PostgreSQL.
         2) Обеспечения доступа к курсору из любого метода класса.
+        3) streaming: выгрузка данных фильмов через именованный серверный курсор
+           порциями по itersize строк вместо fetchall().
+        4) aggregated: выгрузка фильмов одной строкой на фильм, персоны и жанры
+           собираются в json-массивы на стороне PostgreSQL, даты в них уже
+           приходят строками ISO 8601.
+        5) page_size: размер страницы айди фильмов, связанных с персонами и жанрами.
         """
+        self.connection = connection
         self.cr = connection.cursor(cursor_factory=RealDictCursor)
+        self.streaming = streaming
+        self.itersize = itersize
+        self.aggregated = aggregated
+        self.page_size = page_size
+
+    def iter_rows(
+        self, query: str, params: tuple, group_key: Optional[str] = None
+    ) -> Iterator[List[dict]]:
+        """
+        Выполняет запрос и отдает строки порциями.
+        group_key: порция режется только при смене значения этого поля, запрос
+        должен быть по нему отсортирован. Так все строки одного фильма попадают
+        в одну порцию.
+        """
+        if not self.streaming:
+            self.cr.execute(query, params)
+            yield self.cr.fetchall()
+            return
+
+        with self.connection.cursor(
+            name="document_data", cursor_factory=RealDictCursor
+        ) as cursor:
+            cursor.itersize = self.itersize
+            cursor.execute(query, params)
+            chunk = []
+            for row in cursor:
+                if len(chunk) >= self.itersize and (
+                    group_key is None or row[group_key] != chunk[-1][group_key]
+                ):
+                    yield chunk
+                    chunk = []
+                chunk.append(row)
+            if chunk:
+                yield chunk
+
+    @staticmethod
+    def get_id_condition(
+        column: str,
+        ids: Optional[Sequence[str]] = None,
+        id_range: Optional[Tuple[str, Optional[str]]] = None,
+    ) -> Tuple[str, tuple]:
+        """
+        Условие выборки документов и его параметры.
+        ids: список айди; id_range: полуинтервал [начало, конец) айди,
+        конец None - до последнего айди. Без обоих условий выбираются все записи.
+        """
+        if ids is not None:
+            return f"{column} = ANY(%s::uuid[])", (list(ids),)
+        if id_range is not None:
+            start, end = id_range
+            if end is None:
+                return f"{column} >= %s::uuid", (start,)
+            return f"{column} >= %s::uuid AND {column} < %s::uuid", (start, end)
+        return "TRUE", ()
+
+    def iter_movies(
+        self,
+        ids: Optional[Sequence[str]] = None,
+        id_range: Optional[Tuple[str, Optional[str]]] = None,
+    ) -> Iterator[List[dict]]:
+        """Строки фильмов порциями, формат строк зависит от режима aggregated."""
+        condition, params = self.get_id_condition("m.id", ids, id_range)
+        query = AGGREGATED_MOVIES_QUERY if self.aggregated else MOVIES_QUERY
+        return observe_chunks(
+            "movie", self.iter_rows(query.format(condition=condition), params, "m_id")
+        )
+
+    def iter_persons(
+        self,
+        ids: Optional[Sequence[str]] = None,
+        id_range: Optional[Tuple[str, Optional[str]]] = None,
+    ) -> Iterator[List[dict]]:
+        """Персоны с полными списками фильмов и ролей, порциями."""
+        condition, params = self.get_id_condition("p.id", ids, id_range)
+        return observe_chunks(
+            "person", self.iter_rows(PERSONS_QUERY.format(condition=condition), params)
+        )
+
+    def iter_genres(
+        self,
+        ids: Optional[Sequence[str]] = None,
+        id_range: Optional[Tuple[str, Optional[str]]] = None,
+    ) -> Iterator[List[dict]]:
+        """Жанры с полными списками фильмов, порциями."""
+        condition, params = self.get_id_condition("g.id", ids, id_range)
+        return observe_chunks(
+            "genre", self.iter_rows(GENRES_QUERY.format(condition=condition), params)
+        )
+
+    def get_names(self, table_name: str, ids: Sequence[str]) -> Dict[str, str]:
+        """Имена персон или жанров (table_name) с айди из ids."""
+        self.cr.execute(
+            f"SELECT id::text, name FROM content.{table_name} WHERE id = ANY(%s::uuid[]);",
+            (list(ids),),
+        )
+        return {row["id"]: row["name"] for row in self.cr.fetchall()}
+
+    def get_relation_changes(
+        self, ids: Sequence[str]
+    ) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Айди фильмов, персон и жанров, затронутых записями журнала
+        content.relation_changes с айди из ids.
+        """
+        self.cr.execute(
+            """
+            SELECT
+                COALESCE(array_agg(DISTINCT movie_id::text)
+                    FILTER (WHERE movie_id IS NOT NULL), ARRAY[]::text[]) as movie_ids,
+                COALESCE(array_agg(DISTINCT person_id::text)
+                    FILTER (WHERE person_id IS NOT NULL), ARRAY[]::text[]) as person_ids,
+                COALESCE(array_agg(DISTINCT genre_id::text)
+                    FILTER (WHERE genre_id IS NOT NULL), ARRAY[]::text[]) as genre_ids
+            FROM content.relation_changes
+            WHERE id = ANY(%s::uuid[]);
+            """,
+            (list(ids),),
+        )
+        row = self.cr.fetchone()
+        return row["movie_ids"], row["person_ids"], row["genre_ids"]
+
+    def get_tombstones(self, ids: Sequence[str]) -> Dict[str, List[str]]:
+        """
+        Айди удаленных документов по записям content.tombstones с айди из ids,
+        сгруппированные по таблице (movie, person, genre).
+        """
+        self.cr.execute(
+            """
+            SELECT table_name, array_agg(DISTINCT document_id::text) as document_ids
+            FROM content.tombstones
+            WHERE id = ANY(%s::uuid[])
+            GROUP BY table_name;
+            """,
+            (list(ids),),
+        )
+        return {row["table_name"]: row["document_ids"] for row in self.cr.fetchall()}
+
+    def purge_journal(self, table_name: str, checkpoints: Sequence[str]) -> int:
+        """
+        Удаление записей журнала table_name (ETL_JOURNAL_TABLES),
+        txid которых меньше всех чекпоинтов из checkpoints.
+        Ошибка очистки не останавливает etl процесс, журнал дочистится позже.
+        :return: число удаленных записей.
+        """
+        try:
+            self.cr.execute(
+                f"DELETE FROM content.{table_name} " "WHERE txid < ALL(%s::xid8[]);",
+                (list(checkpoints),),
+            )
+            deleted = self.cr.rowcount
+            self.cr.connection.commit()
+        except psycopg2.Error:
+            _logger.exception("Failed to purge content.%s", table_name)
+            self.cr.connection.rollback()
+            return 0
+        return deleted
+
+    def iter_related_movie_ids(
+        self, table_name: str, column_name: str, ids: Sequence[str]
+    ) -> Iterator[List[str]]:
+        """
+        Айди фильмов, связанных через table_name с записями, айди которых в ids.
+        Айди без повторов, страницами по page_size, по возрастанию айди.
+        """
+        query = f"""
+            SELECT DISTINCT movie_id
+            FROM content.{table_name}
+            WHERE {column_name} = ANY(%s::uuid[]) AND movie_id > %s::uuid
+            ORDER BY movie_id
+            LIMIT %s;
+        """
+        last_id = DEFAULT_ID
+        while True:
+            self.cr.execute(query, (list(ids), last_id, self.page_size))
+            movie_ids = [row["movie_id"] for row in self.cr.fetchall()]
+            if movie_ids:
+                yield movie_ids
+            if len(movie_ids) < self.page_size:
+                return
+            last_id = movie_ids[-1]
 
     @backoff.on_exception(backoff.expo, Exception)
     @coroutine
     def get_movie_ids(
-        self, target: Coroutine, target_table_name, target_column_name
+        self, target: Coroutine, target_table_name: str, target_column_name: str
     ) -> Coroutine:
-        """Выгрузка айдишников фильмов, связанных с персонами,
-        айди которых в ids и датой обновления из last_checkpoint."""
+        """
+        Выгрузка айдишников всех фильмов, связанных с записями, айди которых в ids
+        (персоны или жанры), вне зависимости от даты обновления самих фильмов.
+        Фильмы отправляются в target страницами по page_size.
+        """
         while True:
             ids: tuple = (yield)
-            last_checkpoint: datetime = (yield)
-            if ids:
-                movie_ids_query = f"""
-                                SELECT m.id, m.modified
-                                FROM content.movie m
-                                LEFT JOIN content.{target_table_name} movie_rel ON movie_rel.movie_id = m.id
-                                WHERE m.modified > '{last_checkpoint}' AND movie_rel.{target_column_name} IN {ids}
-                                ORDER BY m.modified;
-                                """
-                self.cr.execute(movie_ids_query)
-                movie_data = self.cr.fetchall()
-                movie_ids = (m["id"] for m in movie_data)
+            last_checkpoint: str = (yield)
+            if not ids:
+                continue
+            for movie_ids in self.iter_related_movie_ids(
+                target_table_name, target_column_name, ids
+            ):
                 target.send(tuple(movie_ids))
                 target.send(last_checkpoint)
-            else:
-                target.send([])
-                target.send(last_checkpoint)
 
     @backoff.on_exception(backoff.expo, Exception)
     @coroutine
     def load_movie_data(self, target: Coroutine) -> Coroutine:
-        """Выгрузка информации по фильмам, айди которых приходит в ids."""
+        """
+        Выгрузка информации по фильмам, айди которых приходит в ids.
+        Строки отправляются дальше порциями, конец пачки обозначается None.
+        """
         while True:
             ids: tuple = (yield)
             last_checkpoint: datetime = (yield)
-            if not ids:
-                target.send([])
-            else:
-                movies_query = f"""
-                                SELECT
-                                    m.id as m_id,
-                                    m.title,
-                                    m.description,
-                                    m.rating,
-                                    m.type,
-                                    m.created,
-                                    m.modified,
-                                    m.auth_required,
-                                    movie_person.role as role,
-                                    p.id as p_id,
-                                    p.name as p_name,
-                                    p.created as p_created,
-                                    p.modified as p_modified,
-                                    g.id as g_id,
-                                    g.name as g_name,
-                                    g.description as g_description,
-                                    g.created as g_created,
-                                    g.modified as g_modified
-                                FROM content.movie m
-                                LEFT JOIN content.movie_person_rel movie_person ON movie_person.movie_id = m.id
-                                LEFT JOIN content.person p ON p.id = movie_person.person_id
-                                LEFT JOIN content.movie_genre_rel gm ON gm.movie_id = m.id
-                                LEFT JOIN content.genre g ON g.id = gm.genre_id
-                                where m.id in {ids};
-                                """
-                self.cr.execute(movies_query)
-                movie_data = self.cr.fetchall()
-                target.send(movie_data)
+            if ids:
+                for chunk in self.iter_movies(ids=ids):
+                    target.send(chunk)
+            target.send(None)
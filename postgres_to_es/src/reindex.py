@@ -0,0 +1,237 @@
+import logging
+import re
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2
+from elasticsearch import Elasticsearch
+from psycopg2.extensions import (
+    ISOLATION_LEVEL_DEFAULT,
+    ISOLATION_LEVEL_REPEATABLE_READ,
+)
+
+from postgres_to_es.src.es_loader import ESLoader
+from postgres_to_es.src.etl import ETL, format_date
+from postgres_to_es.src.postgres_loader import PostgresLoader
+from postgres_to_es.src.settings import (
+    DEFAULT_DATE,
+    DEFAULT_TXID,
+    ES_FORCEMERGE_TIMEOUT,
+    ES_NUMBER_OF_REPLICAS,
+    ES_SCHEMAS,
+    ETL_JOURNAL_TABLES,
+    ETL_TABLES,
+    INDEX_NAMES,
+    POSTGRES_DSN,
+)
+from postgres_to_es.src.storage import BaseStorage
+
+_logger = logging.getLogger(__name__)
+
+
+class SnapshotStorage(BaseStorage):
+    """
+    Состояние etl процесса, которое никуда не сохраняется.
+    Чекпоинты всех таблиц начинаются с момента since, журналов - с транзакции
+    since_txid.
+    """
+
+    def __init__(self, since: str = DEFAULT_DATE, since_txid: str = DEFAULT_TXID):
+        self.since = since
+        self.since_txid = since_txid
+
+    def retrieve_state(self) -> dict:
+        state = {}
+        for table in ETL_TABLES:
+            if table in ETL_JOURNAL_TABLES:
+                state[f"{table}_last_txid"] = self.since_txid
+            else:
+                state[f"{table}_last_modified"] = self.since
+        return state
+
+    def save_state(self, state: dict) -> None:
+        pass
+
+
+def get_id_ranges(shards: int) -> List[Tuple[str, Optional[str]]]:
+    """
+    Делит пространство uuid на shards равных полуинтервалов [начало, конец),
+    конец последнего - None.
+    """
+    bounds = [f"{i * 2 ** 128 // shards:032x}" for i in range(shards)]
+    bounds = [f"{b[:8]}-{b[8:12]}-{b[12:16]}-{b[16:20]}-{b[20:]}" for b in bounds]
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def load_shard(
+    index_names: Dict[str, str],
+    id_range: Tuple[str, Optional[str]],
+    snapshot_id: str,
+    aggregated: bool,
+) -> None:
+    """
+    Загрузка одного шарда в отдельном процессе со своими соединениями с Postgres и ES.
+    Транзакция импортирует снимок snapshot_id, поэтому все шарды видят одни данные.
+    """
+    connection = psycopg2.connect(**POSTGRES_DSN)
+    try:
+        connection.set_session(
+            isolation_level=ISOLATION_LEVEL_REPEATABLE_READ, readonly=True
+        )
+        db_loader = PostgresLoader(connection, streaming=True, aggregated=aggregated)
+        db_loader.cr.execute("SET TRANSACTION SNAPSHOT %s;", (snapshot_id,))
+        _logger.info("Shard %s loading started", id_range)
+        ETL(SnapshotStorage(), db_loader, ESLoader()).load_all(index_names, id_range)
+    finally:
+        connection.close()
+
+
+class Reindexer:
+    def __init__(self, elastic: Elasticsearch, db_loader, es_loader):
+        """
+        Полная переиндексация: данные из снимка Postgres загружаются в новые версии
+        индексов (movies_v7 и т.д.), после чего алиасы movies, genres и persons
+        атомарно переключаются на них.
+        """
+        self.elastic = elastic
+        self.db_loader = db_loader
+        self.es_loader = es_loader
+
+    def get_next_index_name(self, alias: str) -> str:
+        """Имя следующей версии индекса: movies_v7 после movies_v6."""
+        pattern = re.compile(rf"^{re.escape(alias)}_v(\d+)$")
+        versions = [0]
+        for index_name in self.elastic.indices.get(index=f"{alias}_v*"):
+            match = pattern.match(index_name)
+            if match:
+                versions.append(int(match.group(1)))
+        return f"{alias}_v{max(versions) + 1}"
+
+    def create_index(self, alias: str) -> str:
+        """
+        Создает новую версию индекса алиаса.
+        На время загрузки refresh и реплики выключены.
+        """
+        index_name = self.get_next_index_name(alias)
+        body = deepcopy(ES_SCHEMAS[alias])
+        body["settings"].update({"refresh_interval": "-1", "number_of_replicas": 0})
+        self.elastic.indices.create(index=index_name, body=body)
+        _logger.info("Index %s created", index_name)
+        return index_name
+
+    def finalize_index(self, alias: str, index_name: str) -> List[str]:
+        """
+        Возвращает индексу рабочие настройки, сливает сегменты и атомарно
+        переключает на него алиас.
+        :return: индексы, на которые алиас указывал раньше.
+        """
+        self.elastic.indices.put_settings(
+            index=index_name,
+            body={
+                "index": {
+                    "refresh_interval": ES_SCHEMAS[alias]["settings"][
+                        "refresh_interval"
+                    ],
+                    "number_of_replicas": ES_NUMBER_OF_REPLICAS,
+                }
+            },
+        )
+        self.elastic.indices.forcemerge(
+            index=index_name, max_num_segments=1, request_timeout=ES_FORCEMERGE_TIMEOUT
+        )
+        self.elastic.indices.refresh(index=index_name)
+
+        actions = [{"add": {"index": index_name, "alias": alias}}]
+        old_indices = []
+        if self.elastic.indices.exists_alias(name=alias):
+            old_indices = list(self.elastic.indices.get_alias(name=alias))
+            actions = [
+                {"remove": {"index": old_index, "alias": alias}}
+                for old_index in old_indices
+            ] + actions
+        elif self.elastic.indices.exists(index=alias):
+            # индекс, созданный до перехода на алиасы, удаляется той же операцией
+            actions.insert(0, {"remove_index": {"index": alias}})
+        self.elastic.indices.update_aliases(body={"actions": actions})
+        _logger.info("Alias %s switched to %s", alias, index_name)
+        return old_indices
+
+    def load_snapshot(
+        self, index_names: Dict[str, str], workers: int = 1
+    ) -> Tuple[str, str]:
+        """
+        Загружает все документы в index_names из одного снимка Postgres
+        (транзакция REPEATABLE READ только на чтение).
+        workers: при нескольких воркерах таблицы делятся на диапазоны uuid,
+        каждый загружается в своем процессе из экспортированного снимка.
+        :return: время снимка и граница фиксации снимка для журналов: транзакции
+        с меньшим txid в снимок уже попали.
+        """
+        connection = self.db_loader.connection
+        connection.rollback()
+        connection.set_session(
+            isolation_level=ISOLATION_LEVEL_REPEATABLE_READ, readonly=True
+        )
+        try:
+            self.db_loader.cr.execute("""
+                SELECT
+                    now() as snapshot_time,
+                    pg_snapshot_xmin(pg_current_snapshot())::text as snapshot_txid,
+                    pg_export_snapshot() as snapshot_id;
+                """)
+            snapshot = self.db_loader.cr.fetchone()
+            snapshot_time = format_date(snapshot["snapshot_time"])
+            if workers > 1:
+                # снимок доступен воркерам, пока открыта эта транзакция
+                self.load_shards(index_names, snapshot["snapshot_id"], workers)
+            else:
+                etl = ETL(SnapshotStorage(), self.db_loader, self.es_loader)
+                etl.load_all(index_names)
+        finally:
+            connection.rollback()
+            connection.set_session(
+                isolation_level=ISOLATION_LEVEL_DEFAULT, readonly=False
+            )
+        return snapshot_time, snapshot["snapshot_txid"]
+
+    def load_shards(
+        self, index_names: Dict[str, str], snapshot_id: str, workers: int
+    ) -> None:
+        """Параллельная загрузка шардов в workers процессах."""
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    load_shard,
+                    index_names,
+                    id_range,
+                    snapshot_id,
+                    self.db_loader.aggregated,
+                )
+                for id_range in get_id_ranges(workers)
+            ]
+            for future in futures:
+                future.result()
+
+    def catch_up(self, since: str, since_txid: str) -> None:
+        """
+        Догружает через алиасы изменения, сделанные после снимка:
+        один проход обычного etl процесса с чекпоинтами от момента снимка.
+        """
+        etl = ETL(SnapshotStorage(since, since_txid), self.db_loader, self.es_loader)
+        etl.run_cycle(etl.build_producers())
+
+    def run(self, delete_old: bool = False, workers: int = 1) -> None:
+        """Полная переиндексация всех направлений в workers процессах."""
+        index_names = {
+            table: self.create_index(alias) for table, alias in INDEX_NAMES.items()
+        }
+        snapshot_time, snapshot_txid = self.load_snapshot(index_names, workers)
+        for table, alias in INDEX_NAMES.items():
+            old_indices = self.finalize_index(alias, index_names[table])
+            # алиас указывает на новый индекс, кеш movies_api сбрасывается целиком
+            self.es_loader.publish(alias)
+            if delete_old and old_indices:
+                self.elastic.indices.delete(index=",".join(old_indices))
+                _logger.info("Indices %s deleted", old_indices)
+        self.catch_up(snapshot_time, snapshot_txid)
@@ -1,6 +1,6 @@
 from datetime import datetime
 from os import environ as env
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
 from dotenv import load_dotenv
 
@@ -12,12 +12,64 @@ DB_NAME: str = env["db_name"]
 DB_USER: str = env["db_user"]
 DB_PASSWORD: str = env["db_password"]
 DB_SCHEME: str = env["db_scheme"]
+POSTGRES_DSN: dict = {
+    "host": DB_HOST,
+    "port": DB_PORT,
+    "database": DB_NAME,
+    "user": DB_USER,
+    "password": DB_PASSWORD,
+    "options": f"-c search_path={DB_SCHEME}",
+}
 DEFAULT_SLEEP_TIME: int = 6
 DEFAULT_DATE: str = datetime(day=1, month=1, year=1980).strftime("%Y-%m-%d %H:%M:%S.%f")
+DEFAULT_ID: str = "00000000-0000-0000-0000-000000000000"
+DEFAULT_TXID: str = "0"
+# таблицы, изменения которых отслеживает etl процесс
+ETL_TABLES: Tuple[str, ...] = (
+    "movie",
+    "genre",
+    "person",
+    "relation_changes",
+    "tombstones",
+)
+# журналы изменений: читаются по номеру транзакции txid до границы фиксации
+# и удаляются после обработки всеми процессами
+ETL_JOURNAL_TABLES: Tuple[str, ...] = ("relation_changes", "tombstones")
+ETL_PAGE_SIZE: int = int(env.get("etl_page_size", 1000))
+ETL_METRICS_PORT: int = int(env.get("etl_metrics_port", 0))
+ETL_STORAGE: str = env.get("etl_storage", "redis")
+ETL_STORAGE_PATH: str = env.get("etl_storage_path", "etl_state.sqlite3")
+ETL_PARALLEL: bool = env.get("etl_parallel", "false").lower() == "true"
+ETL_LISTEN: bool = env.get("etl_listen", "false").lower() == "true"
+ETL_LISTEN_TIMEOUT: float = float(env.get("etl_listen_timeout", 60))
+ETL_NOTIFY_CHANNEL: str = "etl_changes"
+ETL_PARTIAL_UPDATES: bool = env.get("etl_partial_updates", "false").lower() == "true"
+ETL_VALIDATION_RATE: float = float(env.get("etl_validation_rate", 0))
+POSTGRES_STREAMING: bool = env.get("postgres_streaming", "false").lower() == "true"
+POSTGRES_ITERSIZE: int = int(env.get("postgres_itersize", 2000))
+POSTGRES_AGGREGATED: bool = env.get("postgres_aggregated", "false").lower() == "true"
 BASE_ES_URL: str = "http://127.0.0.1:9200/"
 BASE_REDIS_HOST: str = "localhost"
 # BASE_ES_URL: str = "http://elasticsearch:9200/"
 # BASE_REDIS_HOST: str = "redis_db"
+ES_BULK_MAX_BYTES: int = int(env.get("es_bulk_max_bytes", 10 * 1024 * 1024))
+ES_BULK_MAX_DOCS: int = int(env.get("es_bulk_max_docs", 1000))
+ES_MAX_IN_FLIGHT: int = int(env.get("es_max_in_flight", 1))
+ES_MAX_RETRIES: int = int(env.get("es_max_retries", 5))
+ES_RETRY_DELAY: float = float(env.get("es_retry_delay", 1))
+ES_RETRY_MAX_DELAY: float = 60
+ES_DEAD_LETTER_PATH: str = env.get("es_dead_letter_path", "dead_letter.ndjson")
+ES_GZIP: bool = env.get("es_gzip", "false").lower() == "true"
+ES_GZIP_LEVEL: int = int(env.get("es_gzip_level", 5))
+ES_POOL_SIZE: int = int(env.get("es_pool_size", 10))
+ES_SKIP_UNCHANGED: bool = env.get("es_skip_unchanged", "false").lower() == "true"
+ES_HASHES_PATH: str = env.get("es_hashes_path", "document_hashes.sqlite3")
+ES_PUBLISH_INDEXED: bool = env.get("es_publish_indexed", "false").lower() == "true"
+ES_INDEXED_CHANNEL: str = "es_indexed"
+ES_NUMBER_OF_REPLICAS: int = int(env.get("es_number_of_replicas", 1))
+ES_FORCEMERGE_TIMEOUT: int = int(env.get("es_forcemerge_timeout", 3600))
+# ETL отдает даты в ISO 8601, второй формат оставлен для уже загруженных документов
+ES_DATE_FORMAT: str = "strict_date_optional_time||yyyy-MM-dd HH:mm:ss.SSSSSS"
 DEFAULT_MOVIE_ES_SCHEMA: dict = {
     "settings": {
         "refresh_interval": "1s",
@@ -60,8 +112,8 @@ DEFAULT_MOVIE_ES_SCHEMA: dict = {
             "imdb_rating": {"type": "float"},
             "auth_required": {"type": "boolean"},
             "type": {"type": "text", "analyzer": "ru_en"},
-            "created_at": {"type": "date", "format": "YYYY-MM-DD HH:mm:ss.SSSSSS"},
-            "updated_at": {"type": "date", "format": "YYYY-MM-DD HH:mm:ss.SSSSSS"},
+            "created_at": {"type": "date", "format": ES_DATE_FORMAT},
+            "updated_at": {"type": "date", "format": ES_DATE_FORMAT},
             "genres": {
                 "type": "nested",
                 "dynamic": "false",
@@ -74,7 +126,7 @@ DEFAULT_MOVIE_ES_SCHEMA: dict = {
                 "type": "nested",
                 "dynamic": "false",
                 "properties": {
-                    "id": {"uuid": "keyword"},
+                    "uuid": {"type": "keyword"},
                     "full_name": {"type": "text", "analyzer": "ru_en"},
                 },
             },
@@ -138,8 +190,8 @@ DEFAULT_GENRE_ES_SCHEMA: dict = {
             },
             "description": {"type": "text", "analyzer": "ru_en"},
             "film_ids": {"type": "text", "analyzer": "ru_en"},
-            "created_at": {"type": "date", "format": "YYYY-MM-DD HH:mm:ss.SSSSSS"},
-            "updated_at": {"type": "date", "format": "YYYY-MM-DD HH:mm:ss.SSSSSS"},
+            "created_at": {"type": "date", "format": ES_DATE_FORMAT},
+            "updated_at": {"type": "date", "format": ES_DATE_FORMAT},
         },
     },
 }
@@ -188,9 +240,19 @@ DEFAULT_PERSON_ES_SCHEMA: dict = {
                 "analyzer": "ru_en",
                 "fields": {"raw": {"type": "keyword"}},
             },
-            "created_at": {"type": "date", "format": "YYYY-MM-DD HH:mm:ss.SSSSSS"},
-            "updated_at": {"type": "date", "format": "YYYY-MM-DD HH:mm:ss.SSSSSS"},
+            "created_at": {"type": "date", "format": ES_DATE_FORMAT},
+            "updated_at": {"type": "date", "format": ES_DATE_FORMAT},
         },
     },
 }
 DEFAULT_PERSON_INDEX_NAME: Optional[str] = "persons"
+INDEX_NAMES: Dict[str, str] = {
+    "movie": DEFAULT_MOVIE_INDEX_NAME,
+    "genre": DEFAULT_GENRE_INDEX_NAME,
+    "person": DEFAULT_PERSON_INDEX_NAME,
+}
+ES_SCHEMAS: Dict[str, dict] = {
+    DEFAULT_MOVIE_INDEX_NAME: DEFAULT_MOVIE_ES_SCHEMA,
+    DEFAULT_GENRE_INDEX_NAME: DEFAULT_GENRE_ES_SCHEMA,
+    DEFAULT_PERSON_INDEX_NAME: DEFAULT_PERSON_ES_SCHEMA,
+}
@@ -1,30 +1,113 @@
-from json import dumps, loads
+import sqlite3
+from abc import ABC, abstractmethod
+from json import loads
 
 import backoff
 from redis import Redis
 
+# ключ состояния до перехода на хеш, читается один раз при миграции
+LEGACY_STATE_KEY = "data"
 
-class RedisStorage:
-    def __init__(self, redis_adapter: Redis):
+
+class BaseStorage(ABC):
+    """
+    Хранилище чекпоинтов etl процесса: плоский словарь строк.
+    save_state вызывается после подтверждения загрузки пачки в ES
+    и должен сохранить как минимум изменившиеся поля state.
+    """
+
+    @abstractmethod
+    def save_state(self, state: dict) -> None:
+        pass
+
+    @abstractmethod
+    def retrieve_state(self) -> dict:
+        pass
+
+
+class RedisStorage(BaseStorage):
+    def __init__(self, redis_adapter: Redis, key: str = "etl:checkpoints"):
+        """
+        key: хеш с чекпоинтами, каждый чекпоинт - отдельное поле
+        (movie_last_modified, movie_last_id, ...). Параллельные пайплайны пишут
+        только свои поля и не перезаписывают чекпоинты друг друга.
+        """
         self.redis_adapter = redis_adapter
+        self.key = key
+        # последние сохраненные значения полей, чтобы писать только изменения
+        self.saved = {}
 
     @backoff.on_exception(backoff.expo, Exception)
     def save_state(self, state: dict) -> None:
         """
-         Сохранение состояния в Редис.
-         Архитектура данных следующая:
-        {'data':
-         {'movie': {'id': 'modified', ...}},
-         {'genre': {'id': 'modified', ...},
-         {'person': {'id': 'modified', ...}}
-        }
+        Сохранение изменившихся чекпоинтов в хеш одним конвейером (MULTI/EXEC).
+        Вызывается после того, как ES подтвердил загрузку пачки.
         """
-        self.redis_adapter.set("data", dumps(state))
+        changed = {
+            field: value
+            for field, value in state.items()
+            if self.saved.get(field) != value
+        }
+        if not changed:
+            return
+        pipeline = self.redis_adapter.pipeline()
+        pipeline.hset(self.key, mapping=changed)
+        pipeline.execute()
+        self.saved.update(changed)
 
     @backoff.on_exception(backoff.expo, Exception)
     def retrieve_state(self) -> dict:
-        """Получение сохренных данных из Редиса в виде словаря."""
-        raw_data = self.redis_adapter.get("data")
-        if raw_data is None:
-            return {}
-        return loads(raw_data)
+        """
+        Получение сохренных данных из Редиса в виде словаря.
+        Если хеш пуст, переносит в него состояние из старого JSON-ключа data.
+        """
+        state = self.redis_adapter.hgetall(self.key)
+        if not state:
+            raw_data = self.redis_adapter.get(LEGACY_STATE_KEY)
+            if raw_data is None:
+                return {}
+            state = loads(raw_data)
+            self.save_state(state)
+        self.saved = dict(state)
+        return state
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str):
+        """
+        Локальное хранилище чекпоинтов в файле SQLite без сетевых запросов.
+        Журнал WAL позволяет параллельным пайплайнам писать в один файл,
+        каждый чекпоинт - отдельная строка таблицы checkpoints.
+        """
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL;")
+        # в режиме WAL запись переживает сбой процесса и без полной синхронизации
+        self.connection.execute("PRAGMA synchronous=NORMAL;")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints "
+            "(field TEXT PRIMARY KEY, value TEXT NOT NULL);"
+        )
+        self.saved = {}
+
+    def save_state(self, state: dict) -> None:
+        """Сохранение изменившихся чекпоинтов одной транзакцией."""
+        changed = [
+            (field, value)
+            for field, value in state.items()
+            if self.saved.get(field) != value
+        ]
+        if not changed:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO checkpoints (field, value) VALUES (?, ?) "
+                "ON CONFLICT (field) DO UPDATE SET value = excluded.value;",
+                changed,
+            )
+        self.saved.update(changed)
+
+    def retrieve_state(self) -> dict:
+        """Получение сохраненных чекпоинтов в виде словаря."""
+        state = dict(self.connection.execute("SELECT field, value FROM checkpoints;"))
+        self.saved = dict(state)
+        return state
@@ -43,3 +43,74 @@ create table if not exists content.movie_person_rel (
                               modified timestamptz default now());
 create unique index if not exists movie_genre on content.movie_genre_rel (movie_id, genre_id);
 create unique index if not exists movie_person_rel_index on content.movie_person_rel (movie_id, person_id, role);
+create index if not exists movie_modified_id on content.movie (modified, id);
+create index if not exists person_modified_id on content.person (modified, id);
+create index if not exists genre_modified_id on content.genre (modified, id);
+create or replace function content.notify_etl_changes() returns trigger as $$
+begin
+    perform pg_notify('etl_changes', TG_TABLE_NAME);
+    return null;
+end;
+$$ language plpgsql;
+create or replace trigger movie_etl_changes after insert or update or delete on content.movie
+    for each statement execute function content.notify_etl_changes();
+create or replace trigger person_etl_changes after insert or update or delete on content.person
+    for each statement execute function content.notify_etl_changes();
+create or replace trigger genre_etl_changes after insert or update or delete on content.genre
+    for each statement execute function content.notify_etl_changes();
+-- журналы изменений для etl процесса: записи, которые обработали все его процессы,
+-- etl удаляет сам (PostgresLoader.purge_journal), роли etl нужно право DELETE.
+-- etl читает журналы по номеру транзакции txid, а не по modified: now() - время начала
+-- транзакции, и транзакция, начатая раньше, может зафиксироваться позже чекпоинта
+create table if not exists content.relation_changes (
+                              id uuid primary key default gen_random_uuid(),
+                              movie_id uuid,
+                              person_id uuid,
+                              genre_id uuid,
+                              modified timestamptz default now(),
+                              txid xid8 not null default pg_current_xact_id());
+alter table content.relation_changes add column if not exists txid xid8 not null default pg_current_xact_id();
+drop index if exists content.relation_changes_modified_id;
+create index if not exists relation_changes_txid_id on content.relation_changes (txid, id);
+create or replace function content.log_relation_changes() returns trigger as $$
+begin
+    if TG_OP in ('UPDATE', 'DELETE') then
+        insert into content.relation_changes (movie_id, person_id, genre_id)
+        values (OLD.movie_id, (to_jsonb(OLD)->>'person_id')::uuid, (to_jsonb(OLD)->>'genre_id')::uuid);
+    end if;
+    if TG_OP in ('INSERT', 'UPDATE') then
+        insert into content.relation_changes (movie_id, person_id, genre_id)
+        values (NEW.movie_id, (to_jsonb(NEW)->>'person_id')::uuid, (to_jsonb(NEW)->>'genre_id')::uuid);
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+create or replace trigger movie_person_rel_changes after insert or update or delete on content.movie_person_rel
+    for each row execute function content.log_relation_changes();
+create or replace trigger movie_genre_rel_changes after insert or update or delete on content.movie_genre_rel
+    for each row execute function content.log_relation_changes();
+create or replace trigger relation_changes_etl_changes after insert on content.relation_changes
+    for each statement execute function content.notify_etl_changes();
+create table if not exists content.tombstones (
+                              id uuid primary key default gen_random_uuid(),
+                              document_id uuid not null,
+                              table_name varchar(20) not null,
+                              modified timestamptz default now(),
+                              txid xid8 not null default pg_current_xact_id());
+alter table content.tombstones add column if not exists txid xid8 not null default pg_current_xact_id();
+drop index if exists content.tombstones_modified_id;
+create index if not exists tombstones_txid_id on content.tombstones (txid, id);
+create or replace function content.log_tombstones() returns trigger as $$
+begin
+    insert into content.tombstones (document_id, table_name) values (OLD.id, TG_TABLE_NAME);
+    return null;
+end;
+$$ language plpgsql;
+create or replace trigger movie_tombstones after delete on content.movie
+    for each row execute function content.log_tombstones();
+create or replace trigger person_tombstones after delete on content.person
+    for each row execute function content.log_tombstones();
+create or replace trigger genre_tombstones after delete on content.genre
+    for each row execute function content.log_tombstones();
+create or replace trigger tombstones_etl_changes after insert on content.tombstones
+    for each statement execute function content.notify_etl_changes();